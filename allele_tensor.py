@@ -0,0 +1,141 @@
+# Allele resolved MHC overlap: a sparse allele x protein x protein tensor built in one pass by build_MHCI_matrix /
+# build_MHCII_matrix (by_allele=True). Its sum over alleles is the usual overlap matrix, and the matrix for any allele
+# subset (a patient's HLA type) or population frequency weighting is one weighted bincount over its entries.
+
+from store import smallest_dtype
+import numpy as np
+import argparse
+import os
+import re
+
+
+# One nonzero cell, as returned by main.allele_rows: the binders of protein row predicted for allele occur value times
+# in protein col
+ENTRY_DTYPE = [("allele", "S32"), ("row", np.int32), ("col", np.int32), ("value", np.float64)]
+
+
+class AlleleTensor:
+    """Overlap of each pair of proteins :names split by MHC allele, in coordinate form: the binders of protein rows[k]
+    predicted for allele alleles[allele[k]] occur values[k] times in protein cols[k]. Cells not listed are 0."""
+
+    def __init__(self, names, alleles, allele, rows, cols, values):
+        self.names = names
+        self.alleles = alleles
+        self.allele = np.asarray(allele)
+        self.rows = np.asarray(rows)
+        self.cols = np.asarray(cols)
+        self.values = np.asarray(values)
+        self._codes = None
+        self._cells = None
+
+    @classmethod
+    def from_entries(cls, names, entries):
+        """Make a tensor from an ENTRY_DTYPE array of :entries (None for no entries)"""
+        if entries is None:
+            entries = np.zeros(0, dtype=ENTRY_DTYPE)
+        alleles, allele = np.unique(entries["allele"], return_inverse=True)
+        return cls(list(names), [a.decode("ascii") for a in alleles.tolist()], allele.ravel(), entries["row"],
+                   entries["col"], entries["value"])
+
+    def __len__(self):
+        return len(self.values)
+
+    def allele_weights(self, alleles=None, weights=None):
+        """Return the weight of each allele of the tensor: :weights[allele] for a dict of :weights, else 1 for every
+        allele in :alleles (default all). Alleles not given get 0."""
+        if weights is not None:
+            return np.array([weights.get(a, 0.0) for a in self.alleles])
+        if alleles is None:
+            return np.ones(len(self.alleles))
+        wanted = set(alleles)
+        return np.array([float(a in wanted) for a in self.alleles])
+
+    def codes(self):
+        """Return the flat index (row * n + col) of the cell of each entry"""
+        if self._codes is None:
+            self._codes = self.rows.astype(np.int64) * len(self.names) + self.cols
+        return self._codes
+
+    def matrix(self, alleles=None, weights=None):
+        """Return the n x n overlap matrix for an allele subset or weighting (see allele_weights). Given neither, this
+        is the matrix build_MHCI_matrix / build_MHCII_matrix return."""
+        n = len(self.names)
+        w = self.allele_weights(alleles, weights)
+        return np.bincount(self.codes(), weights=self.values * w[self.allele], minlength=n * n).reshape(n, n)
+
+    def matrices(self, weights):
+        """Return the overlap matrices of many weightings at once: :weights is patients x alleles (ordered as
+        self.alleles) and the result patients x n x n."""
+
+        n = len(self.names)
+        if self._cells is None:
+            # Entries grouped by cell, so each cell is one contiguous run for np.add.reduceat
+            order = np.argsort(self.codes(), kind="stable")
+            cells, starts = np.unique(self.codes()[order], return_index=True)
+            self._cells = order, cells, starts
+        order, cells, starts = self._cells
+
+        weights = np.atleast_2d(weights)
+        out = np.zeros((len(weights), n * n))
+        if len(order):
+            contributions = weights[:, self.allele[order]] * self.values[order]
+            out[:, cells] = np.add.reduceat(contributions, starts, axis=1)
+        return out.reshape(len(weights), n, n)
+
+    def save(self, fn):
+        """Write the tensor to :fn as a compressed .npz, each column in the smallest dtype holding it"""
+        tmp = fn + ".tmp"
+        with open(tmp, mode="wb") as out:
+            np.savez_compressed(out, names=np.array(self.names, dtype=str), alleles=np.array(self.alleles, dtype=str),
+                                allele=self.allele.astype(smallest_dtype(self.allele)),
+                                rows=self.rows.astype(smallest_dtype(self.rows)),
+                                cols=self.cols.astype(smallest_dtype(self.cols)),
+                                values=self.values.astype(smallest_dtype(self.values)))
+        os.replace(tmp, fn)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as data:
+            return cls(data["names"].tolist(), data["alleles"].tolist(), data["allele"], data["rows"], data["cols"],
+                       data["values"])
+
+
+def read_allele_weights(fn):
+    """Read allele weights from :fn. Lines of "allele weight" (or "allele,weight") give population frequencies, any
+    other line is a list of allele names (comma or whitespace separated, as in HLA_alleles/*.txt) each weighted 1."""
+
+    weights = dict()
+    with open(fn) as f:
+        for line in f:
+            fields = [x for x in re.split(r"[,\s]+", line.strip()) if x]
+            try:
+                weight = float(fields[1]) if len(fields) == 2 else None
+            except ValueError:
+                weight = None
+            if weight is not None:
+                weights[fields[0]] = weight
+            else:
+                weights.update((allele, 1.0) for allele in fields)
+    return weights
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Reduce an allele resolved overlap tensor (main.py --by-allele) to an "
+                                                 "overlap matrix for a set of alleles or population weights")
+    parser.add_argument("tensor")
+    parser.add_argument("out", nargs="?", default=None, help="matrix csv to write (default: print the alleles)")
+    parser.add_argument("--alleles", nargs="+", default=None, help="only count binders of these alleles")
+    parser.add_argument("--weights", default=None, help="file of allele weights, e.g. HLA_alleles/HLA1_alleles.txt")
+    args = parser.parse_args()
+
+    tensor = AlleleTensor.load(args.tensor)
+    if args.out is None:
+        print("{} proteins, {} alleles, {} nonzero cells".format(len(tensor.names), len(tensor.alleles), len(tensor)))
+        print(",".join(tensor.alleles))
+    else:
+        weights = None if args.weights is None else read_allele_weights(args.weights)
+        # Frequency weighted counts are fractional
+        fmt = '%10.1f' if weights is None else '%12.5f'
+        np.savetxt(args.out, tensor.matrix(alleles=args.alleles, weights=weights), delimiter=',', fmt=fmt,
+                   comments="", header=",".join(tensor.names))
@@ -0,0 +1,239 @@
+# Benchmarks for matrix building, prediction parsing, peptide comparison and clique search.
+#
+# Every case runs in a fresh process, so the peak RSS reported is its own and a case that runs past --timeout can be
+# stopped. Results can be saved as a JSON baseline (--save) and later runs compared against one (--compare).
+
+from bron_kerbosch import csv_2_array, find_cliques, matrix_graph, maximum_cliques, partitions
+from fasta import read_fasta
+from main import compare_peptides, netMHC_prediction
+from naive import build_matrix
+import multiprocessing
+import numpy as np
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def synthetic_predictions(fn, lines, MHC, protein="P0", sequence=None, seed=0):
+    """Write :lines peptide lines of made up netMHC-4.0 (:MHC 1) or netMHCIIpan (:MHC 2) output for :protein to :fn.
+    Peptides are windows of :sequence (random if not given), split over a few alleles, with random affinities and
+    ranks."""
+
+    rng = np.random.default_rng(seed)
+    if sequence is None:
+        sequence = "".join(rng.choice(list(AMINO_ACIDS), 1000))
+    if MHC == 1:
+        alleles, lengths = ["HLA-A0101", "HLA-A0201", "HLA-B0702"], [8, 9, 10, 11]
+        header = ("pos  HLA  peptide  Core Offset  I_pos  I_len  D_pos  D_len  iCore  Identity 1-log50k(aff) "
+                  "Affinity(nM)    %Rank  BindLevel")
+    else:
+        alleles, lengths = ["DRB1_0101", "HLA-DPA10103-DPB10101"], [15]
+        header = ("Seq          Allele              Peptide      Identity  Pos      Core  Core_Rel 1-log50k(aff) "
+                  "Affinity(nM)  %Rank Exp_Bind BindingLevel")
+    windows = [(i, n) for n in lengths for i in range(len(sequence) - n + 1)]
+    per_allele = -(-lines // len(alleles))
+
+    with open(fn, mode="w") as out:
+        print("# synthetic predictions\n", file=out)
+        written = 0
+        for allele in alleles:
+            print("-" * 20, header, "-" * 20, sep="\n", file=out)
+            for j in range(min(per_allele, lines - written)):
+                i, n = windows[j % len(windows)]
+                peptide = sequence[i:i + n]
+                rank = round(rng.uniform(0, 100) ** 1.5 / 10, 2)
+                affinity = round(rng.uniform(1, 50000), 2)
+                if MHC == 1:
+                    level = " <= SB" if rank < 0.5 else " <= WB" if rank < 2 else ""
+                    print("    {}  {}  {}  {}  0  0  0  0  0  {}  {}  0.5  {}  {}{}".format(
+                        i, allele, peptide, peptide[:9], peptide, protein, affinity, rank, level), file=out)
+                else:
+                    level = " <=SB" if rank < 0.5 else " <=WB" if rank < 2 else ""
+                    print("{:6d}  {}  {}  {}  {}  {}  0.5  0.5  {}  {}  NA{}".format(
+                        i, allele, peptide, protein, i + 3, peptide[3:12], affinity, rank, level), file=out)
+            written += min(per_allele, lines - written)
+
+
+# Each case sets up its inputs and returns (work, units, unit): the timed callable, the amount of work it does and
+# the unit of that amount. If units is None, it is the length of what work returns.
+
+def kmer_case(fasta, k, mismatches):
+    proteins = read_fasta(fasta)
+    n = len(proteins)
+    return (lambda: build_matrix(proteins, k, mismatches=mismatches)), n * (n - 1) // 2, "pairs"
+
+
+def parse_case(lines, MHC):
+    fn = os.path.join(tempfile.mkdtemp(), "P0.tsv")
+    synthetic_predictions(fn, lines, MHC)
+    return (lambda: netMHC_prediction(fn, MHC, cache=False)), lines, "lines"
+
+
+def compare_case(fasta, lines, threshold):
+    proteins = read_fasta(fasta)
+    fn = os.path.join(tempfile.mkdtemp(), "P0.tsv")
+    synthetic_predictions(fn, lines, 1, protein=proteins.names[0], sequence=proteins.sequence(0))
+    prediction = netMHC_prediction(fn, 1, cache=False)
+    sequences = proteins.sequences()
+    return (lambda: [compare_peptides(prediction, s, threshold=threshold) for s in sequences]), None, "pairs"
+
+
+def clique_case(csv, method, time_limit):
+    names, data = csv_2_array(csv)
+    graph = matrix_graph(names, data)
+    if method == "find_cliques":
+        return (lambda: find_cliques(graph)), None, "cliques"
+    if method == "maximum_cliques":
+        return (lambda: maximum_cliques(graph, time_limit=time_limit)), None, "cliques"
+    return (lambda: partitions(graph, time_limit=time_limit)), len(names), "nodes"
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _run_case(conn, setup, args):
+    sys.stdout = open(os.devnull, mode="w")
+    # Temporary files of the case go in a directory removed when it finishes
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as work_dir:
+        tempfile.tempdir = work_dir
+        try:
+            work, units, unit = setup(*args)
+            start = time.perf_counter()
+            result = work()
+            wall = time.perf_counter() - start
+            units = len(result) if units is None else units
+            conn.send({"wall": wall, "units": units, "unit": unit, "throughput": units / wall if wall else None,
+                       "peak_rss_mb": peak_rss_mb()})
+        except Exception as e:
+            conn.send({"error": repr(e)})
+
+
+def run_case(setup, args, timeout=None):
+    """Run case :setup(*args) in a fresh process and return its measurements (or an "error" entry)"""
+    context = multiprocessing.get_context("spawn")
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case, args=(send, setup, args))
+    process.start()
+    if receive.poll(timeout):
+        result = receive.recv()
+    else:
+        process.terminate()
+        result = {"error": "timeout after {}s".format(timeout)}
+    process.join()
+    return result
+
+
+def cases(args):
+    """Return the (name, setup, args) of every case selected on the command line"""
+    selected = list()
+    if "kmer" in args.suite:
+        for fasta in sorted(glob.glob(args.fasta)):
+            for k in args.k:
+                for mismatches in args.mismatches:
+                    name = "kmer/{}/k{}/m{}".format(os.path.basename(fasta), k, mismatches)
+                    selected.append((name, kmer_case, (fasta, k, mismatches)))
+    if "parse" in args.suite:
+        for MHC in (1, 2):
+            selected.append(("parse/MHC{}/{}".format(MHC, args.lines), parse_case, (args.lines, MHC)))
+    if "compare" in args.suite:
+        for fasta in sorted(glob.glob(args.compare_fasta)):
+            name = "compare/{}/{}".format(os.path.basename(fasta), args.lines)
+            selected.append((name, compare_case, (fasta, args.lines, 2)))
+    if "cliques" in args.suite:
+        for csv in sorted(glob.glob(args.graphs)):
+            for method in ("find_cliques", "maximum_cliques", "partitions"):
+                name = "cliques/{}/{}".format(os.path.relpath(csv, "k-mer_comparisons"), method)
+                selected.append((name, clique_case, (csv, method, args.time_limit)))
+    return selected
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "time": time.strftime("%Y-%m-%d %H:%M")}
+
+
+def compare(results, baseline, tolerance):
+    """Print each case's wall time against :baseline and return the names of cases more than :tolerance times
+    slower"""
+    slower = list()
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None or "wall" not in old or "wall" not in result:
+            continue
+        ratio = result["wall"] / old["wall"]
+        flag = ""
+        if ratio > tolerance:
+            flag = "  SLOWER"
+            slower.append(name)
+        elif ratio < 1 / tolerance:
+            flag = "  faster"
+        print("{:60s} {:9.3f}s -> {:9.3f}s  x{:.2f}{}".format(name, old["wall"], result["wall"], ratio, flag))
+    return slower
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time matrix building, prediction parsing, peptide comparison and "
+                                                 "clique search, each in its own process")
+    parser.add_argument("--suite", nargs="+", default=["kmer", "parse", "compare", "cliques"],
+                        choices=["kmer", "parse", "compare", "cliques"])
+    parser.add_argument("--fasta", default="sequences/*.fasta", help="glob of fastas for build_matrix")
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 9])
+    parser.add_argument("--mismatches", type=int, nargs="+", default=[0, 1])
+    parser.add_argument("--lines", type=int, default=200000, help="lines of synthetic predictor output")
+    parser.add_argument("--compare-fasta", default="sequences/original_91_Cas9.fasta",
+                        help="glob of fastas whose proteins are compared to one prediction")
+    parser.add_argument("--graphs", default="k-mer_comparisons/*/m6.csv", help="glob of matrix csvs for clique search")
+    parser.add_argument("--time-limit", type=float, default=60, help="seconds for maximum_cliques/partitions")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a case is stopped")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    results = dict()
+    for name, setup, case_args in cases(args):
+        result = run_case(setup, case_args, timeout=args.timeout)
+        results[name] = result
+        if "error" in result:
+            print("{:60s} {}".format(name, result["error"]), flush=True)
+        else:
+            print("{:60s} {:9.3f}s {:8.1f} MB {:12.1f} {}/s".format(
+                name, result["wall"], result["peak_rss_mb"] or 0, result["throughput"] or 0, result["unit"]),
+                flush=True)
+
+    if args.save is not None:
+        with open(args.save, mode="w") as out:
+            json.dump({"meta": metadata(), "results": results}, out, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("\nCompared to {} ({})".format(args.compare, baseline["meta"].get("commit", "")))
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
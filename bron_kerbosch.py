@@ -1,44 +1,96 @@
 from collections import defaultdict
 import numpy as np
-from copy import deepcopy
+import time
 
 
 def find_cliques(graph):
   """Find and return all cliques within a graph."""
 
-  p = set(graph.keys())
-  r = set()
-  x = set()
+  nodes, adjacency = bitset_graph(graph)
+  index = {v: i for i, v in enumerate(nodes)}
+  p = (1 << len(nodes)) - 1
+  x = 0
   cliques = []
 
   for v in degeneracy_ordering(graph):
-    neighs = graph[v]
+    bit = 1 << index[v]
+    neighs = adjacency[index[v]]
 
-    find_cliques_pivot(graph, r.union([v]), p.intersection(neighs), x.intersection(neighs), cliques)
+    cliques.extend(bitset_cliques(adjacency, bit, p & neighs, x & neighs))
 
-    p.remove(v)
-    x.add(v)
+    p &= ~bit
+    x |= bit
 
-  return sorted(cliques, key=lambda x: -len(x))
+  return sorted([bitset_nodes(c, nodes) for c in cliques], key=lambda x: -len(x))
 
 
 def find_cliques_including(item, graph):
   """Find and return all cliques in a graph including item."""
 
-  r = set({item})
-  p = set(graph[item])
-  x = set()
-  cliques = []
+  nodes, adjacency = bitset_graph(graph)
+  index = {v: i for i, v in enumerate(nodes)}
+  if adjacency[index[item]] == 0:
+    return []
+
+  cliques = bitset_cliques(adjacency, 1 << index[item], adjacency[index[item]], 0)
+  return sorted([bitset_nodes(c, nodes) for c in cliques], key=lambda x: -len(x))
+
+
+def bitset_graph(graph):
+  """Return the nodes of :graph (dict of adjacency lists) and their neighbours as integer bitsets,
+  where bit i stands for nodes[i]."""
+
+  nodes = list(graph)
+  index = {v: i for i, v in enumerate(nodes)}
+  adjacency = [0] * len(nodes)
+  for v, neighs in graph.items():
+    for w in neighs:
+      if w != v:
+        adjacency[index[v]] |= 1 << index[w]
+  return nodes, adjacency
+
 
-  for v in list(p):
-    neighs = graph[v]
+def bitset_nodes(bits, nodes):
+  """Return the set of :nodes whose bits are set in :bits."""
 
-    find_cliques_pivot(graph, r.union([v]), p.intersection(neighs), x.intersection(neighs), cliques)
+  members = set()
+  while bits:
+    low = bits & -bits
+    members.add(nodes[low.bit_length() - 1])
+    bits ^= low
+  return members
 
-    p.remove(v)
-    x.add(v)
 
-  return sorted(cliques, key=lambda x: -len(x))
+def bitset_cliques(adjacency, r, p, x):
+  """Yield the maximal cliques (as bitsets) extending clique :r with candidates :p and excluded nodes :x.
+  Iterative Bron-Kerbosch with Tomita pivoting: the pivot is the node of p | x with most neighbours in p."""
+
+  stack = [(r, p, x)]
+  while stack:
+    r, p, x = stack.pop()
+    if p == 0:
+      if x == 0:
+        yield r
+      continue
+
+    pivot, best = 0, -1
+    rest = p | x
+    while rest:
+      low = rest & -rest
+      u = low.bit_length() - 1
+      degree = (p & adjacency[u]).bit_count()
+      if degree > best:
+        pivot, best = u, degree
+      rest ^= low
+
+    candidates = p & ~adjacency[pivot]
+    while candidates:
+      low = candidates & -candidates
+      v = low.bit_length() - 1
+      stack.append((r | low, p & adjacency[v], x & adjacency[v]))
+      p ^= low
+      x |= low
+      candidates ^= low
 
 
 def find_cliques_pivot(graph, r, p, x, cliques):
@@ -53,6 +105,77 @@ def find_cliques_pivot(graph, r, p, x, cliques):
       x.add(v)
 
 
+def maximum_cliques(graph, item=None, all_maximum=True, time_limit=None):
+  """Find and return the largest cliques in a graph (including :item, if given) by branch and bound.
+  Candidates are greedily coloured and a branch is pruned as soon as its clique size plus the number of colours
+  left cannot reach the best size found (MCQ). Returns all maximum cliques, or just one if :all_maximum is False.
+  If :time_limit (seconds) runs out, the largest cliques found so far are returned."""
+
+  # Renumber nodes by decreasing degree, which keeps colourings small
+  nodes = sorted(graph, key=lambda v: -len(graph[v]))
+  nodes, adjacency = bitset_graph({v: graph[v] for v in nodes})
+  if item is None:
+    r, p = 0, (1 << len(nodes)) - 1
+  else:
+    i = nodes.index(item)
+    r, p = 1 << i, adjacency[i]
+  if r == 0 and p == 0:
+    return []
+
+  deadline = None if time_limit is None else time.time() + time_limit
+  cliques = bitset_maximum_cliques(adjacency, r, p, all_maximum=all_maximum, deadline=deadline)
+  return [bitset_nodes(c, nodes) for c in cliques]
+
+
+def bitset_maximum_cliques(adjacency, r, p, all_maximum=True, deadline=None):
+  """Return the largest cliques (as bitsets) extending clique :r with nodes from bitset :p (see maximum_cliques).
+  The search stops early once time.time() passes :deadline."""
+
+  best = {"size": 0, "cliques": []}
+  # Ties are only worth exploring when all maximum cliques are wanted
+  slack = 0 if all_maximum else 1
+
+  def expand(r, size, p):
+    order, colours = colour_sort(adjacency, p)
+    for v, colour in zip(reversed(order), reversed(colours)):
+      if size + colour < best["size"] + slack or (deadline is not None and time.time() > deadline):
+        return
+      bit = 1 << v
+      candidates = p & adjacency[v]
+      if candidates:
+        expand(r | bit, size + 1, candidates)
+      elif size + 1 > best["size"]:
+        best["size"], best["cliques"] = size + 1, [r | bit]
+      elif size + 1 == best["size"] and all_maximum:
+        best["cliques"].append(r | bit)
+      p &= ~bit
+
+  if p == 0:
+    return [r] if r else []
+  expand(r, bin(r).count("1"), p)
+  return best["cliques"]
+
+
+def colour_sort(adjacency, p):
+  """Greedily colour the nodes in bitset :p so that no two neighbours share a colour.
+  Returns the nodes in order of colour and the colour (counting from 1) of each."""
+
+  order, colours = [], []
+  colour = 0
+  uncoloured = p
+  while uncoloured:
+    colour += 1
+    q = uncoloured
+    while q:
+      low = q & -q
+      v = low.bit_length() - 1
+      uncoloured ^= low
+      q &= ~low & ~adjacency[v]
+      order.append(v)
+      colours.append(colour)
+  return order, colours
+
+
 def degeneracy_ordering(graph):
   ordering = []
   ordering_set = set()
@@ -100,46 +223,155 @@ def remove_tips(tip_list, graph):
 
 
 def csv_2_array(fn, trailing=False):
-  """Parse immune overlap matrix csv"""
+  """Parse immune overlap matrix csv. With :trailing, every row ends in a comma."""
   with open(fn) as dm:
     names = [x.strip() for x in dm.readline().split(sep=',')]
-    if not trailing:
-      data = np.asarray([list(map(float, x)) for x in
-                        [list(map(str.strip, y)) for y in
-                        [z.split(sep=',') for z in dm.readlines()]]])
-    else:
-      data = np.asarray([list(map(float, x)) for x in
-                        [list(map(str.strip, y)) for y in
-                        [z.split(sep=',')[:-1] for z in dm.readlines()]]])
+    if trailing and names[-1] == "":
+      names.pop()
+    data = np.loadtxt(dm, delimiter=',', ndmin=2, usecols=range(len(names)) if trailing else None)
   return names, data
 
 
-def partition(orthogonal_graph, clusters):
-    """ Build a set of mutually exclusive cliques in graph :orthogonal_graph.
-    Iteratively finds the largest clique and prunes the members from the graph."""
+def matrix_bitsets(data, threshold=0.0):
+  """Return the adjacency of the orthogonality graph of overlap matrix :data as integer bitsets (see bitset_graph):
+  node i is joined to node j when data[i, j] <= :threshold, so a threshold above 0 gives "nearly orthogonal" pairs."""
 
-    if len(orthogonal_graph) > 0:
-        sorted_cliques = find_cliques(orthogonal_graph)
-        max_cliques = [s for s in sorted_cliques if len(s) == len(sorted_cliques[0])]
-        for clk in max_cliques:
-            c = deepcopy(clusters)
-            c.append(clk)
-            g = remove_tips([tip for tip in clk], deepcopy(orthogonal_graph))
-            partition(g, c)
-    else:
-        global cluster_sets
-        cluster_sets.append(clusters)
+  mask = np.asarray(data) <= threshold
+  np.fill_diagonal(mask, False)
+  bits = np.packbits(mask, axis=1, bitorder='little')
+  return [int.from_bytes(row.tobytes(), 'little') for row in bits]
+
+
+def matrix_graph(names, data, threshold=0.0):
+  """Return the orthogonality graph of overlap matrix :data as a dict of adjacency lists keyed by :names
+  (see matrix_bitsets)."""
+
+  mask = np.asarray(data) <= threshold
+  np.fill_diagonal(mask, False)
+  return {names[i]: [names[j] for j in np.flatnonzero(row)] for i, row in enumerate(mask)}
+
+
+def _residual_cliques(adjacency, memo, residual):
+  """Return the maximum cliques (as bitsets) of the subgraph induced by bitset :residual in order of their lowest
+  node, memoized in :memo. Taking the first one at every step then always gives a partition (see _canonical)."""
+  if residual not in memo:
+    memo[residual] = sorted(bitset_maximum_cliques(adjacency, 0, residual), key=lambda c: c & -c)
+  return memo[residual]
+
+
+def iter_partitions(orthogonal_graph):
+  """Yield every distinct set of mutually exclusive cliques built by repeatedly taking a maximum clique of what is
+  left of :orthogonal_graph, as lists of sets.
+  The residual graph is a bitmask, so nothing is copied per branch, and the maximum cliques of each distinct
+  residual graph are only searched for once. Each set is built once, in canonical order (see _canonical)."""
+
+  nodes = sorted(orthogonal_graph, key=lambda v: -len(orthogonal_graph[v]))
+  nodes, adjacency = bitset_graph({v: orthogonal_graph[v] for v in nodes})
+  memo = dict()
+  stack = [((1 << len(nodes)) - 1, [])]
+  while stack:
+    residual, chosen = stack.pop()
+    if residual == 0:
+      yield [bitset_nodes(c, nodes) for c in chosen]
+      continue
+    for clique in reversed(_residual_cliques(adjacency, memo, residual)):
+      if _canonical(clique, chosen[-1] if chosen else 0):
+        stack.append((residual & ~clique, chosen + [clique]))
+
+
+def _canonical(clique, last):
+  """Return whether :clique may follow clique :last (bitsets) in a partition.
+  Clique sizes never grow along a partition, and any order of a run of equal size cliques gives the same partition,
+  so equal size cliques are only taken in order of their lowest node."""
+  return bin(clique).count("1") < bin(last).count("1") or (clique & -clique) > (last & -last)
+
+
+def partitions(orthogonal_graph, top=10, time_limit=None):
+  """Return up to :top of the partitions iter_partitions() would yield, best first: fewest rounds, then the
+  largest cliques earliest. If :time_limit (seconds) runs out, the best found so far are returned."""
+
+  nodes = sorted(orthogonal_graph, key=lambda v: -len(orthogonal_graph[v]))
+  nodes, adjacency = bitset_graph({v: orthogonal_graph[v] for v in nodes})
+  deadline = None if time_limit is None else time.time() + time_limit
+  best = bitset_partitions(adjacency, dict(), top=top, deadline=deadline)
+  return [[bitset_nodes(c, nodes) for c in chosen] for chosen in best]
+
+
+def bitset_partitions(adjacency, memo, top=10, deadline=None):
+  """Return up to :top partitions of the graph of bitsets :adjacency (see bitset_graph) as lists of clique bitsets,
+  best first (see partitions). :memo holds the maximum cliques (see _residual_cliques) and the best completions
+  (see _best_completions) of residual graphs, and can be kept across searches of the same graph. The search stops
+  early once time.time() passes :deadline."""
+
+  best, _ = _best_completions(adjacency, memo, (1 << len(adjacency)) - 1, 0, top, deadline)
+  return [list(chosen) for _, chosen in best]
+
+
+def _best_completions(adjacency, memo, residual, last, top, deadline):
+  """Return up to :top ways to partition bitset :residual into rounds after clique :last (0 for none), best first,
+  as (score, cliques) pairs, where a higher score (-rounds, clique sizes) is better, and whether the search was
+  complete. Completions depend only on :residual and, through _canonical, on :last when its size is that of the
+  maximum cliques of :residual, so complete results are memoized in :memo under those. A clique is skipped when even
+  the fewest rounds the nodes it leaves could take (their number over their maximum clique size), all of its size,
+  can't beat the worst completion kept."""
+
+  if residual == 0:
+    return [((0, ()), ())], True
+  cliques = _residual_cliques(adjacency, memo, residual)
+  size = bin(cliques[0]).count("1")
+  if bin(last).count("1") != size:
+    last = 0
+  key = ("completions", residual, last & -last, top)
+  if key in memo:
+    return memo[key], True
+
+  if size == 1:
+    # Only single nodes are left, which go one per round in order
+    singles = cliques if last == 0 else [c for c in cliques if c > (last & -last)]
+    kept = [((-len(singles), (1,) * len(singles)), tuple(sorted(singles)))] if len(singles) == len(cliques) else []
+    memo[key] = kept
+    return kept, True
+
+  kept, complete = [], True
+  for clique in cliques:
+    if last and not _canonical(clique, last):
+      continue
+    rest = residual & ~clique
+    if top is not None and len(kept) == top:
+      rounds = 1
+      if rest:
+        rounds += -(-bin(rest).count("1") // bin(_residual_cliques(adjacency, memo, rest)[0]).count("1"))
+      if (-rounds, (size,) * rounds) <= kept[-1][0]:
+        continue
+    if deadline is not None and time.time() > deadline:
+      complete = False
+      break
+    found, done = _best_completions(adjacency, memo, rest, clique, top, deadline)
+    complete &= done
+    kept.extend(((score[0] - 1, (size,) + score[1]), (clique,) + chosen) for score, chosen in found)
+    kept = sorted(kept, key=lambda item: item[0], reverse=True)[:top]
+
+  if complete:
+    memo[key] = kept
+  return kept, complete
 
 
 if __name__ == "__main__":
-    k = 5
-    names, data = csv_2_array('naive/m{}.csv'.format(k))
-    size = len(names)
-    orthogonal_graph = {names[i]:
-                            [names[j] for j in range(size) if data[i, j] == 0.0 and i != j]
-                        for i in range(size)
-                        }
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Partition the proteins of an overlap matrix csv into rounds of "
+                                                 "mutually orthogonal proteins (see pipeline.py for the whole flow)")
+    parser.add_argument("csv", help="overlap matrix, e.g. naive/m5.csv from naive.py")
+    parser.add_argument("--trailing", action="store_true", help="rows end in a comma")
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--time-limit", type=float, default=None)
+    args = parser.parse_args()
 
-    cluster_sets = list()
+    names, data = csv_2_array(args.csv, trailing=args.trailing)
+    names[0] = names[0].lstrip("#").strip()
+    orthogonal_graph = matrix_graph(names, data, threshold=args.threshold)
 
-    partition(orthogonal_graph, [])
+    cluster_sets = partitions(orthogonal_graph, top=args.top, time_limit=args.time_limit)
+    for clusters in cluster_sets:
+        print("{} rounds: {}".format(len(clusters), " | ".join(",".join(sorted(c)) for c in clusters)))
@@ -1,16 +1,9 @@
-import numpy as np
 from bron_kerbosch import *
 
 
-with open('full_matrix.csv') as dm:
-	names = [x.strip() for x in dm.readline().split(sep=',')]
-	data = np.asarray([list(map(float, x)) for x in
-						[list(map(str.strip, y)) for y in
-						[z.split(sep=',') for z in dm.readlines()]]])
+names, data = csv_2_array('full_matrix.csv')
 
-size = len(names)
-
-orthogonal_graph = {names[i]: [names[j] for j in range(size) if data[i, j] == 0.0 and i != j] for i in range(size)}
+orthogonal_graph = matrix_graph(names, data)
 
 sorted_cliques = find_cliques_including("AAK33936.1", orthogonal_graph)
 
@@ -0,0 +1,59 @@
+# Multi-fasta loading without Biopython, straight into the residue buffer layout of naive.encode.
+
+from collections import namedtuple
+import numpy as np
+
+
+# Stands in for a SeqRecord: code reading .name and .seq takes either
+Protein = namedtuple("Protein", ["name", "seq"])
+
+
+class Fasta:
+    """Proteins of a multi-fasta as their names plus one uint8 residue buffer, protein i being
+    buffer[offsets[i]:offsets[i + 1]] (see naive.encode, which returns these arrays without copying).
+    Indexing and iteration give Protein(name, seq) records, with seq decoded from the buffer on demand."""
+
+    def __init__(self, names, buffer, offsets):
+        self.names = names
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Protein(self.names[i], self.sequence(i))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def sequence(self, i):
+        """Return the sequence of protein :i as a str"""
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("ascii")
+
+    def sequences(self):
+        """Return all sequences as strs, decoding the buffer once"""
+        text = self.buffer.tobytes().decode("ascii")
+        return [text[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+
+def read_fasta(fn):
+    """Read multi-fasta :fn with one bulk read and return it as a Fasta. Names are the first word of each header
+    (SeqRecord.name), whitespace inside sequences is dropped and anything before the first header is ignored."""
+
+    with open(fn, "rb") as f:
+        data = f.read()
+
+    records = (b"\n" + data).split(b"\n>")[1:]
+    names, seqs = list(), list()
+    for record in records:
+        title, _, seq = record.partition(b"\n")
+        title = title.split(None, 1)
+        names.append(title[0].decode("ascii") if title else "")
+        seqs.append(seq.translate(None, b" \t\r\n\v\f"))
+
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in seqs])
+    return Fasta(names, np.frombuffer(b"".join(seqs), dtype=np.uint8), offsets)
@@ -1,11 +1,22 @@
 # Identify highly immunogenic peptides from orthologs to design multiple-round therapy to minimize cross-reactivity.
 
-from Bio import SeqIO
-from subprocess import run
+from subprocess import CalledProcessError
+from allele_tensor import ENTRY_DTYPE, AlleleTensor
+from concurrent.futures import ThreadPoolExecutor
+from fasta import read_fasta
+from naive import encode, load_previous, merge_previous, new_pair_rows, peptide_hits, select, update_rows
+from parallel import build_rows, fingerprint
+from pair_cache import sequence_digests, uncached_proteins
+from store import MatrixStore, write_store
 import numpy as np
+import argparse
+import asyncio
+import metrics
+import pair_cache
 import shlex
+import signal
 import os
-import sys
+import tempfile
 
 
 # Set of all HLA alleles used in analysis. For HLA-2, all combinations of DPA and DPB were used.
@@ -149,6 +160,18 @@ HLA_2_DQB = ['DQB1_0201', 'DQB1_0202', 'DQB1_0203', 'DQB1_0204', 'DQB1_0205', 'D
 				 'DQB1_0639', 'DQB1_0640', 'DQB1_0641', 'DQB1_0642', 'DQB1_0643', 'DQB1_0644']
 
 
+# Predictor command lines. {alleles} and {fasta} are filled in by run_predictions, which runs them in a
+# temporary directory. Any executable taking the same arguments can stand in for the real predictor.
+
+NETMHC_I = "/Applications/netMHC-4.0/netMHC -a {alleles} -t 0.1 -s -l 8,9,10,11 -f {fasta}"
+NETMHC_II = "/Applications/netMHCIIpan-3.1/netMHCIIpan -a {alleles} -u -s -f {fasta}"
+
+# Alleles predicted when none are given
+DEFAULT_ALLELES = {1: HLA_1_ALLELES.split(","), 2: ["DRB1_1501"]}
+
+# Column of the protein identifier in predictor output lines
+IDENTITY_COLUMN = {1: 10, 2: 3}
+
 class Peptide:
     """Class used to store MHC binding attributes of a peptide as predicted by netMHC"""
 
@@ -200,33 +223,204 @@ class Peptide:
         return repr(self)
 
 
+# Columns of the parsed prediction cache, in Peptide attribute names. HLA and protein are stored as ids into
+# the allele and protein name lists and binding as an index into BINDING_LEVELS.
+PREDICTION_COLUMNS = {1: ["position", "HLA", "seq", "core", "offset", "insertion_position", "insertion_length",
+                          "deletion_position", "deletion_length", "interaction_core", "protein", "pAffinity",
+                          "nM_affinity", "percentile_rank", "binding"],
+                      2: ["position", "HLA", "seq", "core", "offset", "protein", "pAffinity", "nM_affinity",
+                          "percentile_rank", "binding"]}
+BINDING_LEVELS = [None, "weak", "strong"]
+
+
+def peptide_array(peptides, MHC):
+    """Return Peptide objects :peptides as a structured array with one field per PREDICTION_COLUMNS entry.
+    HLA and protein are stored as strings and binding as an index into BINDING_LEVELS."""
+
+    dtype = list()
+    for name in PREDICTION_COLUMNS[int(MHC)]:
+        if name in ("seq", "core", "interaction_core"):
+            dtype.append((name, "S{}".format(max([len(getattr(p, name)) for p in peptides], default=1))))
+        elif name in ("HLA", "protein"):
+            dtype.append((name, "U{}".format(max([len(getattr(p, name)) for p in peptides], default=1))))
+        elif name in ("pAffinity", "nM_affinity", "percentile_rank"):
+            dtype.append((name, np.float64))
+        elif name == "binding":
+            dtype.append((name, np.int8))
+        else:
+            dtype.append((name, np.int32))
+
+    array = np.zeros(len(peptides), dtype=dtype)
+    for name in PREDICTION_COLUMNS[int(MHC)]:
+        values = [getattr(p, name) for p in peptides]
+        if name == "binding":
+            values = [BINDING_LEVELS.index(v) for v in values]
+        elif name in ("seq", "core", "interaction_core"):
+            values = [v.encode("ascii") for v in values]
+        array[name] = values
+    return array
+
+
+def stream_predictions(filename, MHC, threshold=None, affinity=None, level=None, batch_size=None, metadata=None):
+    """Parse netMHC output :filename line by line, yielding only the peptides with percentile rank below :threshold,
+    affinity below :affinity nM and binding :level ('strong', or 'weak' which also admits strong binders), for
+    whichever filters are given. Rows are filtered before a Peptide object is made for them.
+    With :batch_size, yields structured arrays of up to :batch_size peptides (see peptide_array) instead.
+    Comment lines are appended to the list :metadata if one is given."""
+
+    MHC = int(MHC)
+    rank_column, affinity_column, binding_length = {1: (13, 12, 16), 2: (9, 8, 12)}[MHC]
+    flags = {None: None, "strong": ("S",), "weak": ("S", "W")}[level]
+    batch = list()
+
+    with open(filename) as inputfile:
+        for line in inputfile:
+            x = line.strip()
+            if len(x) == 0:
+                continue
+            if x[0] == "#" and metadata is not None:
+                metadata.append(x)
+            if not x[0].isdigit():
+                continue
+
+            attributes = x.split()
+            if threshold is not None and not float(attributes[rank_column]) < threshold:
+                continue
+            if affinity is not None and not float(attributes[affinity_column]) < affinity:
+                continue
+            if flags is not None and not (len(attributes) == binding_length and
+                                          any(f in attributes[-1] for f in flags)):
+                continue
+
+            if batch_size is None:
+                yield Peptide(x, MHC)
+                continue
+            batch.append(Peptide(x, MHC))
+            if len(batch) == batch_size:
+                yield peptide_array(batch, MHC)
+                batch = list()
+
+    if batch:
+        yield peptide_array(batch, MHC)
+
+
 class netMHC_prediction:
     """Class used to store total MHC binding prediction information for a protein.
     Main attribute is self.peptides which is a list of Peptide objects comprising
-    all peptides in a protein and their binding information for a given MHC allele."""
-
-    def __init__(self, filename, MHC):
-        self.metadata = ""
-        self.peptides = list()
-        with open(filename) as inputfile:
-            print("Parsing netMHC file {}".format(filename))
-            for line in inputfile.readlines():
-                x = line.strip()
-                if len(x) == 0:
-                    continue
-                if x[0] == "#":
-                    self.metadata += "\n" + x
-                if x[0].isdigit():
-                    self.peptides.append(Peptide(x, MHC))
+    all peptides in a protein and their binding information for a given MHC allele.
+
+    Parsed predictions are kept as a NumPy structured array (self.columns) and cached as an .npz file next to
+    :filename, or in directory :cache if it is one, which is reused until the prediction file's modification time or
+    size changes. If the cache can't be written (e.g. a read-only directory), the predictions are just not cached.
+    If any of :threshold, :affinity or :level is given, only peptides passing those filters (see stream_predictions)
+    are read and kept."""
+
+    def __init__(self, filename, MHC, cache=True, threshold=None, affinity=None, level=None):
+        self.MHC = int(MHC)
+        self._peptides = None
+        self._binders = dict()
+        filters = [(name, value) for name, value in (("rank", threshold), ("nM", affinity), ("level", level))
+                   if value is not None]
+        cache_fn = filename + "".join(".{}{}".format(name, value) for name, value in filters) + ".npz"
+        if cache is not True and cache:
+            cache_fn = os.path.join(cache, os.path.basename(cache_fn))
+        stat = os.stat(filename)
+        source = np.array([stat.st_mtime_ns, stat.st_size])
+
+        if cache and os.path.isfile(cache_fn):
+            with np.load(cache_fn) as cached:
+                if (cached["source"] == source).all():
+                    self.columns = cached["columns"]
+                    self.alleles = cached["alleles"].tolist()
+                    self.proteins = cached["proteins"].tolist()
+                    self.metadata = str(cached["metadata"])
+                    metrics.count("prediction_cache_hits")
+                    return
+
+        print("Parsing netMHC file {}".format(filename))
+        metadata = list()
+        with metrics.stage("parse", file=os.path.basename(filename)):
+            peptides = list(stream_predictions(filename, MHC, threshold=threshold, affinity=affinity, level=level,
+                                               metadata=metadata))
+            self.metadata = "".join("\n" + x for x in metadata)
+            self._from_peptides(peptides)
+        metrics.count("parsed_peptides", len(peptides))
+
+        if cache:
+            # A temporary file of its own, so builds sharing the prediction directory can't mix their writes
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_fn) or os.curdir)
+                with os.fdopen(fd, mode="wb") as cache_file:
+                    np.savez(cache_file, source=source, columns=self.columns,
+                             alleles=np.array(self.alleles, dtype=str), proteins=np.array(self.proteins, dtype=str),
+                             metadata=np.array(self.metadata))
+                os.replace(tmp, cache_fn)
+            except OSError as error:
+                print("Not caching {}: {}".format(filename, error))
+                if tmp is not None and os.path.isfile(tmp):
+                    os.remove(tmp)
+
+    def _from_peptides(self, peptides):
+        """Fill the columns from a list of Peptide objects"""
+        array = peptide_array(peptides, self.MHC)
+        self.alleles, alleles = np.unique(array["HLA"], return_inverse=True)
+        self.proteins, proteins = np.unique(array["protein"], return_inverse=True)
+        self.alleles, self.proteins = self.alleles.tolist(), self.proteins.tolist()
+        self.columns = np.zeros(len(array), dtype=[(name, np.int32 if name in ("HLA", "protein") else dtype)
+                                                   for name, (dtype, _) in array.dtype.fields.items()])
+        for name in array.dtype.names:
+            if name not in ("HLA", "protein"):
+                self.columns[name] = array[name]
+        self.columns["HLA"] = alleles.ravel()
+        self.columns["protein"] = proteins.ravel()
+
+    def _peptides_at(self, rows):
+        """Return the rows with indices :rows as Peptide objects"""
+        selected = self.columns[rows]
+        values = dict()
+        for name in selected.dtype.names:
+            column = selected[name].tolist()
+            if name == "HLA":
+                column = [self.alleles[v] for v in column]
+            elif name == "protein":
+                column = [self.proteins[v] for v in column]
+            elif name == "binding":
+                column = [BINDING_LEVELS[v] for v in column]
+            elif selected.dtype[name].kind == "S":
+                column = [v.decode("ascii") for v in column]
+            values[name] = column
+
+        peptides = list()
+        for i in range(len(selected)):
+            p = Peptide.__new__(Peptide)
+            p.__dict__.update({name: column[i] for name, column in values.items()})
+            peptides.append(p)
+        return peptides
+
+    @property
+    def peptides(self):
+        if self._peptides is None:
+            self._peptides = self._peptides_at(np.arange(len(self.columns)))
+        return self._peptides
+
+    def binder_mask(self, threshold=0.5, affinity=False):
+        """Return a boolean mask over self.columns of the peptides get_binders would return"""
+        with metrics.stage("binders"):
+            if affinity:
+                return self.columns["nM_affinity"] < affinity
+            else:
+                return self.columns["percentile_rank"] < threshold
 
     def get_binders(self, threshold=0.5, affinity=False):
-        if affinity:
-            return [p for p in self.peptides if p.nM_affinity < affinity]
-        else:
-            return [p for p in self.peptides if p.percentile_rank < threshold]
+        key = (threshold, affinity)
+        if key not in self._binders:
+            self._binders[key] = self._peptides_at(np.flatnonzero(self.binder_mask(threshold=threshold,
+                                                                                   affinity=affinity)))
+        return list(self._binders[key])
 
     def __len__(self):
-        return len(self.peptides)
+        return len(self.columns)
 
     def __str__(self):
         return "netMHC prediction"
@@ -239,130 +433,419 @@ def count(seq, reference, mismatches=0, positions=False, quick=True):
     if quick:
     	return int(seq in reference)
     
-    n = len(seq)
-    overlap_locations = list()
-    for i in range(len(reference) - n + 1):
-        score = 0
-        for j in range(n):
-            if seq[j] == reference[i + j]:
-                score += 1
-        if n - score <= mismatches:
-            overlap_locations.append(i)
+    overlap = peptide_hits([seq], reference, mismatches=mismatches, positions=positions)[0]
     if positions:
-        return overlap_locations
-    return len(overlap_locations)
+        return overlap.tolist()
+    return int(overlap)
+
+
+def compare_peptides(prediction, seq, threshold=0.5, core=False, mismatches=0):
+    """Count the binders of :prediction (percentile rank below :threshold, with repeats) that occur in :seq with at
+    most :mismatches substitutions. All binders are checked against :seq at once (see naive.peptide_hits)."""
+    s = seq if type(seq) == str else str(seq.seq)
+    metrics.count("pair_comparisons")
+    binders = prediction.columns["core" if core else "seq"][prediction.binder_mask(threshold=threshold)]
+    return int((peptide_hits(binders, s, mismatches=mismatches) > 0).sum())
+
+
+class PeptideIndex:
+    """Index of the distinct peptides of each length in a set of encoded proteins (see naive.encode).
+    Answers which proteins contain a peptide without scanning their sequences. Lengths are indexed on first use."""
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.n = len(offsets) - 1
+        self._lengths = dict()
+
+    def _index(self, length):
+        """Return the sorted distinct peptides of :length and the sorted (peptide id * n + protein) pairs"""
+        if length not in self._lengths:
+            windows = np.maximum(np.diff(self.offsets) - length + 1, 0)
+            protein = np.repeat(np.arange(self.n), windows)
+            starts = np.arange(windows.sum()) - np.repeat(np.cumsum(windows) - windows, windows) + self.offsets[protein]
+            keys = self.buffer[starts[:, None] + np.arange(length)].view(np.dtype((np.void, length))).ravel()
+            peptides, ids = np.unique(keys, return_inverse=True)
+            self._lengths[length] = peptides, np.unique(ids.ravel() * self.n + protein)
+        return self._lengths[length]
+
+    def count(self, peptides, groups=None, n_groups=1):
+        """Return an array holding, for each protein, how many of :peptides (a bytes array, with repeats) it contains.
+        With :groups (an id below :n_groups for each peptide), return an n_groups x n array counting the peptides of
+        each group separately."""
+
+        counts = np.zeros(n_groups * self.n)
+        grouped = groups is not None
+        groups = np.asarray(groups) if grouped else np.zeros(len(peptides), dtype=np.int64)
+        lengths = np.char.str_len(peptides)
+        for length in np.unique(lengths):
+            if length == 0:
+                continue
+            selected = lengths == length
+            distinct, inverse = np.unique(peptides[selected].astype("S{}".format(length)), return_inverse=True)
+            # Distinct (peptide, group) pairs and how often each occurs
+            codes, repeats = np.unique(inverse.ravel() * n_groups + groups[selected], return_counts=True)
+            peptide, group = np.divmod(codes, n_groups)
+            keys = distinct.view(np.uint8).reshape(-1, length).view(np.dtype((np.void, length))).ravel()
+            index, pairs = self._index(length)
+            ids = np.minimum(np.searchsorted(index, keys), max(len(index) - 1, 0))
+            found = ids < len(index)
+            if len(index):
+                found &= index[ids] == keys
+            lo = np.searchsorted(pairs, ids * self.n)
+            sizes = np.where(found, np.searchsorted(pairs, (ids + 1) * self.n) - lo, 0)
+            # Every (peptide, group) pair counts towards each protein containing the peptide
+            lo, sizes = lo[peptide], sizes[peptide]
+            hits = pairs[np.repeat(lo - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())] % self.n
+            counts += np.bincount(np.repeat(group, sizes) * self.n + hits, weights=np.repeat(repeats, sizes),
+                                  minlength=len(counts))
+        counts = counts.reshape(n_groups, self.n)
+        return counts if grouped else counts[0]
+
+
+def compare_rows(buffer, offsets, rows, prediction_fns, MHC, threshold, prediction_cache=True, targets=None,
+                 core=False):
+    """Compare the immunogenic peptides of proteins :rows to the sequences of all later proteins.
+    Used as the row block task of parallel.build_rows; returns a len(:rows) x n array. Equivalent to calling
+    compare_peptides for every pair, but each binder set is looked up once in a PeptideIndex of all sequences.
+    :prediction_cache is the cache argument of netMHC_prediction. If :targets (a boolean mask over proteins) is
+    given, only columns of those proteins are compared, and only their sequences are indexed."""
+
+    index, columns = _column_index(buffer, offsets, targets)
+    overlap = np.zeros((len(rows), len(offsets) - 1))
+    for r, i in enumerate(rows):
+        overlap[r] = _compare_row(index, columns, i, len(offsets) - 1, prediction_fns[i], MHC, threshold,
+                                  prediction_cache, core)
+    return overlap
 
 
-def compare_peptides(prediction, seq, threshold=0.5, core=False):
-    total_overlap = 0
-    for p in prediction.get_binders(threshold=threshold):
-        if type(seq) == str:
-            s = seq
-        else:
-            s = str(seq.seq)
-        if core:
-            total_overlap += count(p.core, s)
-        else:
-            total_overlap += count(p.seq, s)
-    return total_overlap
+def _column_index(buffer, offsets, targets=None):
+    """Return a PeptideIndex of the sequences of :targets (default all proteins) and the column of each"""
+    if targets is None:
+        return PeptideIndex(buffer, offsets), np.arange(len(offsets) - 1)
+    return PeptideIndex(*select(buffer, offsets, targets)), np.flatnonzero(targets)
+
+
+def _compare_row(index, columns, i, n, prediction_fn, MHC, threshold, prediction_cache=True, core=False):
+    """Return row :i of the :n column overlap matrix, filled in :columns > :i from their PeptideIndex :index (see
+    _column_index)"""
+    prediction = netMHC_prediction(prediction_fn, MHC, cache=prediction_cache, threshold=threshold)
+    print("Comparing top {}% immunogenic peptides to other proteins".format(threshold))
+    binders = prediction.columns["core" if core else "seq"][prediction.binder_mask(threshold=threshold)]
+    later = columns > i
+    row = np.zeros(n)
+    with metrics.stage("compare"):
+        row[columns[later]] = index.count(binders)[later]
+    metrics.count("pair_comparisons", later.sum())
+    return row
+
+
+def allele_rows(buffer, offsets, rows, prediction_fns, MHC, threshold, prediction_cache=True, core=False):
+    """Like compare_rows, but with the overlap of each pair split by the allele its binders were predicted for.
+    Used as a sparse row block task of parallel.build_rows; returns the nonzero cells as an
+    allele_tensor.ENTRY_DTYPE array."""
+
+    index = PeptideIndex(buffer, offsets)
+    blocks = [np.zeros(0, dtype=ENTRY_DTYPE)]
+    for i in rows:
+        prediction = netMHC_prediction(prediction_fns[i], MHC, cache=prediction_cache, threshold=threshold)
+        print("Comparing top {}% immunogenic peptides to other proteins by allele".format(threshold))
+        mask = prediction.binder_mask(threshold=threshold)
+        binders = prediction.columns["core" if core else "seq"][mask]
+        with metrics.stage("compare"):
+            counts = index.count(binders, groups=prediction.columns["HLA"][mask], n_groups=len(prediction.alleles))
+        counts[:, :i + 1] = 0
+        allele, col = np.nonzero(counts)
+        block = np.zeros(len(allele), dtype=ENTRY_DTYPE)
+        block["allele"] = np.array(prediction.alleles, dtype="S32")[allele]
+        block["row"] = i
+        block["col"] = col
+        block["value"] = counts[allele, col]
+        blocks.append(block)
+        metrics.count("pair_comparisons", len(offsets) - 2 - i)
+    return np.concatenate(blocks)
+
+
+async def _predict_task(command, batch, alleles, semaphore, timeout=None):
+    """Run predictor :command on the (alias, SeqRecord or fasta.Protein) pairs in :batch for :alleles inside a private
+    temporary directory, once :semaphore admits it, and return its output lines. The predictor and any processes it
+    started are killed if it runs longer than :timeout seconds."""
+
+    async with semaphore:
+        with tempfile.TemporaryDirectory(prefix="prediction_") as work_dir:
+            fasta = os.path.join(work_dir, "batch.fasta")
+            with open(fasta, mode="w") as batch_file:
+                for alias, protein in batch:
+                    print(">{}\n{}".format(alias, protein.seq), file=batch_file)
+            out_fn = os.path.join(work_dir, "prediction.out")
+            args = shlex.split(command.format(alleles=",".join(alleles), fasta=fasta))
+            with open(out_fn, mode="w") as predict_file, \
+                    metrics.stage("predictor", proteins=len(batch), alleles=len(alleles)):
+                process = await asyncio.create_subprocess_exec(*args, stdout=predict_file, cwd=work_dir,
+                                                               start_new_session=True)
+                try:
+                    code = await asyncio.wait_for(process.wait(), timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    os.killpg(process.pid, signal.SIGKILL)
+                    await process.wait()
+                    raise
+            if code != 0:
+                raise CalledProcessError(code, args)
+            with open(out_fn) as predict_file:
+                return predict_file.readlines()
+
+
+async def _predict_retrying(command, batch, alleles, semaphore, timeout=None, retries=2):
+    """_predict_task, run again up to :retries times if the predictor times out or fails"""
+    for attempt in range(retries + 1):
+        try:
+            return await _predict_task(command, batch, alleles, semaphore, timeout=timeout)
+        except (asyncio.TimeoutError, CalledProcessError) as error:
+            metrics.count("predictor_failures")
+            if attempt == retries:
+                raise
+            print("Predictor failed on {} proteins ({}), retrying".format(len(batch), "timed out" if isinstance(
+                error, asyncio.TimeoutError) else "exit status {}".format(error.returncode)))
+
+
+def _write_predictions(batch, names, lines, column, prediction_dir):
+    """Split predictor output :lines for :batch into one file per protein, each written atomically"""
+
+    metadata = list()
+    rows = {alias: list() for alias, _ in batch}
+    for line in lines:
+        x = line.strip()
+        if len(x) == 0:
+            continue
+        if x[0] == "#" and x not in metadata:
+            metadata.append(x)
+        if x[0].isdigit():
+            attributes = x.split()
+            alias = attributes[column]
+            attributes[column] = names[alias]
+            rows[alias].append("  ".join(attributes))
+
+    for alias, protein in batch:
+        prediction_fn = os.path.join(prediction_dir, "{}.tsv".format(protein.name))
+        # Runs sharing :prediction_dir may predict the same protein, so each writes a temporary file of its own
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=prediction_dir)
+        with os.fdopen(fd, mode="w") as predict_file:
+            print("\n".join(metadata + rows[alias]), file=predict_file)
+        os.replace(tmp, prediction_fn)
+
+
+async def predictions_as_completed(proteins, prediction_dir, MHC, alleles, command, workers=1, batch_size=20,
+                                   timeout=None, retries=2):
+    """Predict MHC binding for all :proteins like run_predictions, yielding the position in :proteins of each protein
+    as soon as its <:prediction_dir>/<name>.tsv is written.
+    A task that still times out or fails after :retries retries has its proteins predicted one at a time, so a single
+    protein the predictor hangs on doesn't hold back the rest of its batch. Proteins that fail on their own are
+    reported in an exception once all other predictions are written."""
+
+    # Predictors truncate long identifiers, so submit proteins under short aliases
+    aliased = [("p{}".format(i), protein) for i, protein in enumerate(proteins)]
+    names = {alias: protein.name for alias, protein in aliased}
+    position = {alias: i for i, (alias, _) in enumerate(aliased)}
+    batches = [aliased[i:i + batch_size] for i in range(0, len(aliased), batch_size)]
+    groups = max(1, min(len(alleles), -(-workers // max(len(batches), 1))))
+    allele_groups = [alleles[g::groups] for g in range(groups)]
+    column = IDENTITY_COLUMN[int(MHC)]
+    semaphore = asyncio.Semaphore(max(workers, 1))
+
+    async def predict(batch):
+        tasks = [asyncio.ensure_future(_predict_retrying(command, batch, group, semaphore, timeout=timeout,
+                                                         retries=retries)) for group in allele_groups]
+        try:
+            outputs = await asyncio.gather(*tasks)
+        finally:
+            # Stop the other allele groups of a failed batch
+            for task in tasks:
+                task.cancel()
+        return [line for lines in outputs for line in lines]
+
+    pending = {asyncio.ensure_future(predict(batch)): batch for batch in batches}
+    failed = list()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch = pending.pop(task)
+                try:
+                    lines = task.result()
+                except (asyncio.TimeoutError, CalledProcessError):
+                    if len(batch) > 1:
+                        print("Predicting the {} proteins of a failed batch one at a time".format(len(batch)))
+                        pending.update((asyncio.ensure_future(predict([item])), [item]) for item in batch)
+                    else:
+                        failed.append(names[batch[0][0]])
+                    continue
+                print("Predicted {} proteins".format(len(batch)))
+                metrics.count("predicted_proteins", len(batch))
+                _write_predictions(batch, names, lines, column, prediction_dir)
+                for alias, _ in batch:
+                    yield position[alias]
+    finally:
+        for task in pending:
+            task.cancel()
+    if failed:
+        raise Exception("Predictor failed on {} after {} retries: {}".format(len(failed), retries, ",".join(failed)))
+
+
+def run_predictions(proteins, prediction_dir, MHC, alleles, command, workers=1, batch_size=20, timeout=None,
+                    retries=2):
+    """Predict MHC binding for all :proteins and write the output for each to <:prediction_dir>/<name>.tsv.
+    Proteins are submitted :batch_size at a time as one multi-fasta, the :alleles are split across tasks when there
+    are fewer batches than :workers, and up to :workers predictor processes run at once, each in its own temporary
+    directory. Tasks are killed after :timeout seconds and retried (see predictions_as_completed). Output is split
+    per protein and each file is written atomically."""
+
+    async def predict_all():
+        async for _ in predictions_as_completed(proteins, prediction_dir, MHC, alleles, command, workers=workers,
+                                                batch_size=batch_size, timeout=timeout, retries=retries):
+            pass
+
+    asyncio.run(predict_all())
+
+
+def stream_overlap(buffer, offsets, rows, prediction_fns, MHC, threshold, missing, predictions, new=None,
+                   prediction_cache=True, core=False):
+    """Compute the rows :rows of the overlap matrix like compare_rows while the predictions of proteins :missing are
+    still being made: rows whose predictions exist are compared first, and async iterator :predictions (see
+    predictions_as_completed) yields the positions in :missing of the others as they become ready. With a boolean
+    mask :new, rows of other proteins are only compared to the new columns (see naive.update_rows).
+    Comparisons run in one thread next to the event loop driving the predictors."""
+
+    n = len(offsets) - 1
+    index = _column_index(buffer, offsets)
+    new_index = None if new is None else _column_index(buffer, offsets, new)
+    overlap = np.zeros((n, n))
+    progress = metrics.Progress("rows", len(rows), unit="rows")
+
+    def compare(i):
+        overlap[i] = _compare_row(*(index if new is None or new[i] else new_index), i, n, prediction_fns[i], MHC,
+                                  threshold, prediction_cache, core)
+        progress.update()
+
+    async def compare_all():
+        loop = asyncio.get_running_loop()
+        waiting = set(missing)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            compared = [loop.run_in_executor(pool, compare, i) for i in rows if i not in waiting]
+            async for position in predictions:
+                compared.append(loop.run_in_executor(pool, compare, missing[position]))
+            await asyncio.gather(*compared)
+
+    asyncio.run(compare_all())
+    progress.close()
+    return overlap
 
 
-def build_MHCI_matrix(fasta, prediction_dir, threshold=2, run_missing_predictions=True):
-    """Build immune overlap matrix of all proteins in :fasta.
-    Peptides are classified as binding if affinity is in the top :threshold percentile. Will use exiting predictions if
-    available, if not and :run_missing_predictions flag is True (default) then will call netMHC-4.0 to make predictions.
-    If no prediction can be found and :run_missing_predictions flag is False, raises an exception."""
-
-    proteins = [x for x in SeqIO.parse(fasta, "fasta")]
-    overlap = np.zeros((len(proteins), len(proteins)))
-    predictions = dict()
-
-    for i in range(len(proteins)):
-
-        # Write protein to its own temporary fasta file for prediction input
-        with open("single.fasta", mode="w") as single:
-            print(proteins[i].format("fasta"), file=single)
-
-        # Look for existing prediction
-        prediction_fn = prediction_dir+"/{}.tsv".format(proteins[i].name)
-        if not os.path.isfile(prediction_fn):
-            if run_missing_predictions == False:
-                raise Exception("Can't find prediction file and run_missing_predictions flag is False. Check that "
-                                "predictions are in directory MHCI_predictions and that folder is in the current path.")
-
-            # Run netMCH-4.0 on single protein
-            print("Running netMHC on {}".format(proteins[i].name))
-            with open(prediction_fn, mode="w") as predict_file:
-                run(shlex.split("/Applications/netMHC-4.0/netMHC " \
-                                "-a {0} " \
-                                "-t 0.1 " \
-                                "-s " \
-                                "-l 8,9,10,11 " \
-                                "-f single.fasta".format(HLA_1_ALLELES)), stdout=predict_file)
-
-        # Parse prediction file
-        predictions[proteins[i].name] = netMHC_prediction(prediction_fn, 1)
-
-        # Compare set of immunogenic (defined by :threshold) peptides to all other protein sequence
-        print("Comparing top {}% immunogenic peptides to other proteins".format(threshold))
-        for j in range(i + 1, len(proteins)):
-            overlap[i, j] = compare_peptides(predictions[proteins[i].name], proteins[j], threshold=threshold)
-            print(".", end="")
-
-        run(["rm", "single.fasta"])
-        print("Done")
+def build_MHCI_matrix(fasta, prediction_dir, threshold=2, run_missing_predictions=True, workers=1,
+                      checkpoint_dir=None, alleles=None, predictor=NETMHC_I, previous=None,
+                      by_allele=False, cache=None, timeout=None, retries=2, prediction_cache=True):
+    """Build immune overlap matrix of all proteins in :fasta for MHC class I, calling netMHC-4.0 for missing
+    predictions (see _build_MHC_matrix)."""
+    return _build_MHC_matrix(1, fasta, prediction_dir, threshold, run_missing_predictions, workers, checkpoint_dir,
+                             alleles, predictor, previous, by_allele, cache, timeout, retries, prediction_cache)
 
-    return overlap
+
+def build_MHCII_matrix(fasta, prediction_dir, threshold=2, run_missing_predictions=True, workers=1,
+                       checkpoint_dir=None, alleles=None, predictor=NETMHC_II, previous=None,
+                       by_allele=False, cache=None, timeout=None, retries=2, prediction_cache=True):
+    """Build immune overlap matrix of all proteins in :fasta for MHC class II, calling netMHCIIpan-3.1 for missing
+    predictions (see _build_MHC_matrix)."""
+    return _build_MHC_matrix(2, fasta, prediction_dir, threshold, run_missing_predictions, workers, checkpoint_dir,
+                             alleles, predictor, previous, by_allele, cache, timeout, retries, prediction_cache)
 
 
-def build_MHCII_matrix(fasta, prediction_dir, threshold=2, run_missing_predictions=True):
-    """Build immune overlap matrix of all proteins in :fasta.
+def _build_MHC_matrix(MHC, fasta, prediction_dir, threshold, run_missing_predictions, workers, checkpoint_dir,
+                      alleles, predictor, previous, by_allele, cache, timeout, retries, prediction_cache):
+    """Build immune overlap matrix of all proteins in :fasta for MHC class :MHC (1 or 2).
     Peptides are classified as binding if affinity is in the top :threshold percentile. Will use exiting predictions if
-    available, if not and :run_missing_predictions flag is True (default) then will call netMHCIIpan-3.1 to make predictions.
-    If no prediction can be found and :run_missing_predictions flag is False, raises an exception."""
-
-    proteins = [x for x in SeqIO.parse(fasta, "fasta")]
-    overlap = np.zeros((len(proteins), len(proteins)))
-    predictions = dict()
-
-    for i in range(len(proteins)):
-
-        # Write protein to its own fasta file for netMHCpan input
-        with open("single.fasta", mode="w") as single:
-            print(proteins[i].format("fasta"), file=single)
-
-        # Look for existing predictions
-        prediction_fn = prediction_dir+"/{}.tsv".format(proteins[i].name)
-        if not os.path.isfile(prediction_fn):
-            if run_missing_predictions == False:
-                raise Exception("Can't find prediction file and run_missing_predictions flag is False. Check that "
-                                "predictions are in directory MHCII_predictions and that folder is in the current path.")
-
-            # Run netMHCIIpan on single protein
-            print("Running netMHCIIpan on {}".format(proteins[i].name))
-            run(shlex.split("touch {}".format(prediction_fn)))
-            with open(prediction_fn, mode="w") as predict_file:
-                run(shlex.split("/Applications/netMHCIIpan-3.1/netMHCIIpan " \
-                                "-a {0} " \
-                                "-u " \
-                                "-s " \
-                                "-f single.fasta".format("DRB1_1501")), stdout=predict_file)
-
-        # Parse prediction file
-        predictions[proteins[i].name] = netMHC_prediction(prediction_fn, 2)
-
-        # Compare set of immunogenic (defined by :threshold) peptides to all other protein sequence
-        print("Comparing top {}% immunogenic peptides to other proteins".format(threshold))
-        for j in range(i + 1, len(proteins)):
-            overlap[i, j] = compare_peptides(predictions[proteins[i].name], proteins[j], threshold=threshold)
-            print(".", end="")
-
-        run(["rm", "single.fasta"])
+    available, if not and :run_missing_predictions flag is True then will call :predictor to make predictions.
+    If no prediction can be found and :run_missing_predictions flag is False, raises an exception.
+    Missing predictions for :alleles (default DEFAULT_ALLELES[MHC]) are made by :workers concurrent :predictor
+    processes, killed after :timeout seconds and retried :retries times, and each protein is compared as soon as its
+    prediction is written. With all predictions present, comparisons are split into row blocks computed by :workers
+    processes and checkpointed to :checkpoint_dir. If :previous names an existing matrix csv (header = protein names)
+    or store layer (see naive.load_previous), only pairs involving proteins missing from it are computed. With
+    :by_allele, returns an allele_tensor.AlleleTensor of the overlap split by allele instead, whose matrix() is the
+    overlap matrix. With a pair_cache.PairCache :cache, pairs of sequences it holds for the same threshold and
+    :alleles are not computed again, assuming each sequence's predictions are the same in every run. Parsed
+    predictions are cached as given by :prediction_cache (see netMHC_prediction)."""
+
+    proteins = read_fasta(fasta)
+    prediction_fns = [prediction_dir + "/{}.tsv".format(name) for name in proteins.names]
+    buffer, offsets = encode(proteins)
+    rows = new = None
+    if cache is not None and not by_allele:
+        if previous is not None:
+            raise Exception("Use either a pair cache or a previous matrix, not both.")
+        # Only pairs involving a few proteins covering the uncached pairs need predictions and comparisons
+        digests = sequence_digests(buffer, offsets)
+        mode = "MHC{} threshold={} alleles={}".format(MHC, threshold, "default" if alleles is None else
+                                                        ",".join(sorted(alleles)))
+        cached, found = cache.get_matrix(digests, mode)
+        new = uncached_proteins(found)
+        metrics.count("cached_pairs", found.sum())
+
+    if previous is not None:
+        if by_allele:
+            raise Exception("Allele resolved tensors can't be updated from a previous matrix.")
+        # Only rows of new proteins, and the new columns of rows with a new protein further along, need computing
+        old, new = load_previous(proteins.names, previous)
+    if new is not None:
+        rows = np.union1d(*new_pair_rows(new))
+
+    # Look for existing predictions of the proteins whose rows are computed
+    needed = np.arange(len(proteins)) if rows is None else rows
+    missing = [i for i in needed if not os.path.isfile(prediction_fns[i])]
+    if missing:
+        if run_missing_predictions == False:
+            raise Exception("Can't find prediction file and run_missing_predictions flag is False. Check that "
+                            "predictions are in directory MHC{}_predictions and that folder is in the current "
+                            "path.".format("I" * MHC))
+        if alleles is None:
+            alleles = DEFAULT_ALLELES[MHC]
+        print("Running {} on {} proteins".format("netMHC" if MHC == 1 else "netMHCIIpan", len(missing)))
+
+    # Compare set of immunogenic (defined by :threshold) peptides to all other protein sequences
+    args = (prediction_fns, MHC, threshold, prediction_cache)
+    if by_allele:
+        if missing:
+            run_predictions([proteins[i] for i in missing], prediction_dir, MHC, alleles, predictor, workers=workers,
+                            timeout=timeout, retries=retries)
+        key = fingerprint(buffer, offsets, "MHC{} alleles".format(MHC), threshold, prediction_fns)
+        entries = build_rows(allele_rows, buffer, offsets, args=args, workers=workers, checkpoint_dir=checkpoint_dir,
+                             key=key, sparse=True)
         print("Done")
-
+        return AlleleTensor.from_entries(proteins.names, entries)
+
+    if missing:
+        # Compare each protein as soon as its prediction is written instead of after all of them
+        predictions = predictions_as_completed([proteins[i] for i in missing], prediction_dir, MHC, alleles, predictor,
+                                               workers=workers, timeout=timeout, retries=retries)
+        overlap = stream_overlap(buffer, offsets, needed, prediction_fns, MHC, threshold, missing, predictions,
+                                 new=new, prediction_cache=prediction_cache)
+    elif new is not None:
+        key = fingerprint(buffer, offsets, "MHC{}".format(MHC), threshold, prediction_fns, previous, new.tolist())
+        overlap = update_rows(compare_rows, buffer, offsets, new, args=args, workers=workers,
+                              checkpoint_dir=checkpoint_dir, key=key)
+    else:
+        key = fingerprint(buffer, offsets, "MHC{}".format(MHC), threshold, prediction_fns)
+        overlap = build_rows(compare_rows, buffer, offsets, args=args, workers=workers, checkpoint_dir=checkpoint_dir,
+                             key=key)
+    if previous is not None:
+        overlap = merge_previous(overlap, old, new)
+    if cache is not None:
+        overlap = np.where(found, cached, overlap)
+        cache.put_matrix(digests, mode, overlap, ~found)
+    print("Done")
     return overlap
 
 
+
+
 def direct_peptide(p1, p2, core=True, threshold=2):
     """Compare peptides in prediction object :p1 to those in prediction object :p2.
     This is equivalent, but slower than comparing the peptides in :p1 to the parent sequence for object :p2"""
@@ -378,8 +861,56 @@ def direct_peptide(p1, p2, core=True, threshold=2):
 
 if __name__ == "__main__":
 
-    fn = sys.argv[1]
-    base = fn.split(sep=".")[0]
-    test_matrix = build_MHCI_matrix(fn)
-    # print(test_matrix)
-    np.savetxt(base + "_matrix.csv", test_matrix, delimiter=',', fmt='%10.1f')
+    parser = argparse.ArgumentParser(description="Build MHC class I immune overlap matrix for proteins in a fasta")
+    parser.add_argument("fasta")
+    parser.add_argument("prediction_dir")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for peptide comparisons")
+    parser.add_argument("--checkpoint", default=None, help="directory for resumable row blocks")
+    parser.add_argument("--predictor", default=NETMHC_I,
+                        help="command run for missing predictions, with {alleles} and {fasta} placeholders")
+    parser.add_argument("--predictor-timeout", type=float, default=None, metavar="SECONDS",
+                        help="kill and retry predictor runs taking longer than this")
+    parser.add_argument("--predictor-retries", type=int, default=2, metavar="N",
+                        help="times a failed or timed out predictor run is retried")
+    parser.add_argument("--update", action="store_true",
+                        help="reuse an existing output matrix and only compute pairs with new proteins")
+    parser.add_argument("--store", action="store_true",
+                        help="write the matrix as layer MHCI of <fasta base>.imx (see store.py) instead of a csv")
+    parser.add_argument("--by-allele", action="store_true",
+                        help="also write the overlap split by allele to <fasta base>_alleles.npz (see allele_tensor.py)")
+    pair_cache.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.by_allele and args.update:
+        parser.error("--by-allele always builds from scratch")
+    if args.cache is not None and (args.by_allele or args.update):
+        parser.error("--cache can't be combined with --by-allele or --update")
+
+    with metrics.session(args):
+        cache = pair_cache.from_arguments(args)
+        base = args.fasta.split(sep=".")[0]
+        out_fn = base + ".imx" if args.store else base + "_matrix.csv"
+        if not args.update or not os.path.isfile(out_fn):
+            previous = None
+        elif args.store:
+            previous = (out_fn, "MHCI") if "MHCI" in MatrixStore(out_fn) else None
+        else:
+            previous = out_fn
+        if args.by_allele:
+            tensor = build_MHCI_matrix(args.fasta, args.prediction_dir, workers=args.jobs,
+                                       checkpoint_dir=args.checkpoint, predictor=args.predictor,
+                                       timeout=args.predictor_timeout, retries=args.predictor_retries, by_allele=True)
+            tensor.save(base + "_alleles.npz")
+            test_matrix = tensor.matrix()
+        else:
+            test_matrix = build_MHCI_matrix(args.fasta, args.prediction_dir, workers=args.jobs,
+                                            checkpoint_dir=args.checkpoint, predictor=args.predictor,
+                                            timeout=args.predictor_timeout, retries=args.predictor_retries,
+                                            previous=previous, cache=cache)
+        if cache is not None:
+            cache.close()
+        names = read_fasta(args.fasta).names
+        if args.store:
+            write_store(out_fn, names, {"MHCI": test_matrix})
+        else:
+            np.savetxt(out_fn, test_matrix, delimiter=',', fmt='%10.1f', comments="", header=",".join(names))
@@ -0,0 +1,149 @@
+# Stage timers, counters and progress reporting for long builds, with an optional JSON lines log.
+#
+# Everything is kept per process: work done inside parallel.build_rows worker processes shows up in the parent only
+# through the progress of its row blocks.
+
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+
+
+_lock = threading.Lock()
+timers = defaultdict(lambda: [0, 0.0])
+counters = defaultdict(int)
+_log = None
+
+
+def log(event, **fields):
+    """Append one JSON line describing :event to the metrics log, if one is open (see open_log)"""
+    if _log is None:
+        return
+    with _lock:
+        line = json.dumps(dict(time=round(time.time(), 3), event=event, **fields), default=_plain)
+        print(line, file=_log, flush=True)
+
+
+def _plain(value):
+    """Convert NumPy scalars and other values json can't encode"""
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def open_log(fn):
+    global _log
+    _log = open(fn, mode="a")
+
+
+def close_log():
+    global _log
+    if _log is not None:
+        _log.close()
+        _log = None
+
+
+@contextmanager
+def stage(name, **fields):
+    """Time the enclosed block under :name. Calls and total seconds accumulate in timers[name]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            timers[name][0] += 1
+            timers[name][1] += seconds
+        log("stage", name=name, seconds=round(seconds, 6), **fields)
+
+
+def count(name, n=1):
+    """Add :n to counters[name]"""
+    with _lock:
+        counters[name] += int(n)
+
+
+class Progress:
+    """Report the rate and estimated time left of :total units of work to stderr, at most every :interval seconds
+    and once more when closed, unless all of it took less than a second."""
+
+    def __init__(self, name, total, unit="items", interval=10):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def close(self):
+        self.report(quiet=time.perf_counter() - self.start < 1)
+
+    def report(self, quiet=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        left = (self.total - self.done) / rate if rate > 0 else None
+        eta = "?" if left is None else time.strftime("%H:%M:%S", time.gmtime(left))
+        if not quiet:
+            print("{}: {}/{} {} ({:.0%}), {:.1f} {}/s, ETA {}".format(
+                self.name, self.done, self.total, self.unit, self.done / max(self.total, 1), rate, self.unit, eta),
+                file=sys.stderr, flush=True)
+        log("progress", name=self.name, done=self.done, total=self.total, unit=self.unit,
+            rate=round(rate, 3), eta_seconds=None if left is None else round(left, 1))
+
+
+def summary():
+    """Return the accumulated timers and counters as a dict"""
+    with _lock:
+        return {"timers": {name: {"calls": calls, "seconds": round(seconds, 6)}
+                           for name, (calls, seconds) in timers.items()},
+                "counters": dict(counters)}
+
+
+def report(file=sys.stderr):
+    """Print the accumulated timers (slowest first) and counters"""
+    current = summary()
+    for name, timer in sorted(current["timers"].items(), key=lambda item: -item[1]["seconds"]):
+        print("{:30s} {:10.3f}s {:8d} calls".format(name, timer["seconds"], timer["calls"]), file=file)
+    for name, value in sorted(current["counters"].items()):
+        print("{:30s} {:>11}".format(name, value), file=file)
+
+
+def add_arguments(parser):
+    """Add the --metrics and --profile options used by session() to argparse :parser"""
+    parser.add_argument("--metrics", default=None, metavar="FILE", help="append JSON lines of stage timings to FILE")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="FILE",
+                        help="run under cProfile, print the slowest calls and optionally save the stats to FILE")
+
+
+@contextmanager
+def session(args, top=25):
+    """Run the enclosed block of a command line script with the --metrics log and --profile of parsed :args
+    (see add_arguments), then print the stage summary to stderr."""
+
+    if args.metrics is not None:
+        open_log(args.metrics)
+        log("start", argv=sys.argv)
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(top)
+            if args.profile:
+                profiler.dump_stats(args.profile)
+        report()
+        log("summary", **summary())
+        close_log()
@@ -1,26 +1,87 @@
 import numpy as np
-from Bio import SeqIO
-import regex
-import sys
-
-def prune_similar(seqs):
-	N = len(seqs)
-	lib = []
-	counter = 0
-	for x in seqs:
-		counter += 1
-		dont_add = False
-		for y in lib:
-			if test_similar(x.seq, y.seq):
-				dont_add = True
-		if not dont_add:
-			lib.append(x)
-		if int(N % N/100) == 0:
-			print(".", end="")
-	return lib
-
-def test_similar(x, y):
-	thresh = 20
+from bron_kerbosch import csv_2_array
+from fasta import Fasta, read_fasta
+from pair_cache import sequence_digests, uncached_proteins
+from parallel import build_rows, fingerprint
+from store import MatrixStore, load_layer, write_store
+from collections import defaultdict
+import argparse
+import metrics
+import os
+import pair_cache
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def prune_similar(seqs, threshold=20, batch=64, chunk=256):
+    """Greedily keep the :seqs (see encode, in order) that differ from every sequence kept before them in more than
+    :threshold positions (see test_similar), comparing :batch candidates at a time against the kept set.
+    Positions past the end of a kept sequence count as differences."""
+
+    buffer, offsets = encode(seqs)
+    n = len(offsets) - 1
+    lengths = np.diff(offsets)
+    matrix = np.zeros((n, lengths.max(initial=0)), dtype=np.uint8)
+    protein = np.repeat(np.arange(n), lengths)
+    matrix[protein, np.arange(len(buffer)) - offsets[protein]] = buffer
+
+    kept = list()
+    progress = metrics.Progress("prune_similar", n, unit="sequences")
+    for lo in range(0, n, batch):
+        candidates = np.arange(lo, min(n, lo + batch))
+        similar = np.zeros(n, dtype=bool)
+
+        # Candidate x kept pairs
+        a, b = np.repeat(candidates, len(kept)), np.tile(np.array(kept, dtype=np.int64), len(candidates))
+        metrics.count("prune_pairs", len(a))
+        a, _ = _close_pairs(matrix, lengths, a, b, threshold, chunk)
+        similar[a] = True
+
+        # Greedy pass within the batch over the candidates no kept sequence is close to
+        left = candidates[~similar[candidates]]
+        a, b = np.triu_indices(len(left), 1)
+        a, b = left[b], left[a]
+        metrics.count("prune_pairs", len(a))
+        a, b = _close_pairs(matrix, lengths, a, b, threshold, chunk)
+        close = defaultdict(set)
+        for x, y in zip(a.tolist(), b.tolist()):
+            close[x].add(y)
+        added = set()
+        for x in left.tolist():
+            if not close[x] & added:
+                added.add(x)
+                kept.append(x)
+        progress.update(len(candidates))
+
+    progress.close()
+    return [seqs[i] for i in kept]
+
+
+def _close_pairs(matrix, lengths, a, b, threshold, chunk=256, pairs=2 ** 14):
+    """Return the pairs (a[i], b[i]) of rows of :matrix that differ in at most :threshold of the first lengths[a[i]]
+    positions. Columns are compared :chunk at a time, :pairs pairs at a time, and pairs are dropped as soon as they
+    pass the threshold."""
+
+    close_a, close_b = [a[:0]], [b[:0]]
+    for lo in range(0, len(a), pairs):
+        x, y = a[lo:lo + pairs], b[lo:lo + pairs]
+        distance = np.zeros(len(x), dtype=np.int64)
+        for start in range(0, matrix.shape[1], chunk):
+            if len(x) == 0:
+                break
+            columns = np.arange(start, min(start + chunk, matrix.shape[1]))
+            differ = matrix[x[:, None], columns] != matrix[y[:, None], columns]
+            distance += (differ & (columns < lengths[x, None])).sum(axis=1)
+            keep = distance <= threshold
+            x, y, distance = x[keep], y[keep], distance[keep]
+        close_a.append(x)
+        close_b.append(y)
+    return np.concatenate(close_a), np.concatenate(close_b)
+
+
+def test_similar(x, y, thresh=20):
 	score = 0
 	for i, letter in enumerate(x):
 		if y[i] != letter:
@@ -35,43 +96,458 @@ def compare_all_peptides(p1, p2, k, mismatches=0):
     if mismatches == 0:
         return sum(p1[i:i + k] in p2 for i in range(len(p1) - k))
     else:
-        counter = 0
-        for i in range(len(p1) - k):
-            pro_pattern = p1[i:i + k]
-            counter += len(regex.findall(
-                                        "(" + pro_pattern + "){s<=" + str(mismatches) + "}",
-                                        p2, overlapped=True))
-        return counter
-
-
-def build_matrix(proteins, k, mismatches=0):
-    """Build and return triangle matrix of k-mer overlap for all pairs in :proteins"""
-
-    overlap = np.zeros((len(proteins), len(proteins)))
-    for i in range(len(proteins)):
-        print("Protein # {} ".format(i + 1), end='', flush=True)
-        for j in range(i + 1, len(proteins)):
-            #print(".", end='', flush=True)
-            cross_reactivity = compare_all_peptides(str(proteins[i].seq), str(proteins[j].seq), k,
-                                                    mismatches=mismatches)
-            overlap[i, j] = cross_reactivity
-            overlap[j, i] = cross_reactivity
-        print(".", end="", flush=True)
-    return overlap
+        buffer, offsets = encode([p1, p2])
+        return int(mismatch_rows(buffer, offsets, [0], k, mismatches)[0, 1])
+
+
+def encode(proteins):
+    """Concatenate sequences in :proteins (strings or SeqRecords) into one uint8 residue buffer.
+    Returns the buffer and an array of offsets such that protein i is buffer[offsets[i]:offsets[i + 1]].
+    A fasta.Fasta already holds both and is returned without copying."""
+
+    if isinstance(proteins, Fasta):
+        return proteins.buffer, proteins.offsets
+    seqs = [p if type(p) == str else str(p.seq) for p in proteins]
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in seqs])
+    return np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8), offsets
+
+
+def select(buffer, offsets, mask):
+    """Return the encoded sequences (see encode) of the proteins in boolean :mask"""
+    lengths = np.diff(offsets)[mask]
+    selected = np.zeros(len(lengths) + 1, dtype=offsets.dtype)
+    selected[1:] = np.cumsum(lengths)
+    return buffer[np.repeat(mask, np.diff(offsets))], selected
+
+
+def protein_names(proteins):
+    """Return the names of :proteins (SeqRecords or a fasta.Fasta); strings are their own names"""
+    if isinstance(proteins, Fasta):
+        return proteins.names
+    return [p if type(p) == str else p.name for p in proteins]
+
+
+def kmer_layers(buffer, offsets, ks):
+    """Integer-encode the k-mer windows of the encoded proteins for every k in :ks in a single pass.
+    Yields (k, protein, kmer, counted) in increasing k with one entry per window. Equal k-mers share an id, and
+    :counted marks the windows compare_all_peptides iterates over, i.e. all but the last window of each protein.
+
+    Ids for k + 1 are derived from the ids for k plus one residue, and windows whose k-mer occurs in a single
+    protein are dropped as soon as they appear since no longer k-mer starting there can be shared either."""
+
+    ks = sorted(set(ks))
+    ends = offsets[1:]
+    protein = np.repeat(np.arange(len(ends)), np.diff(offsets))
+    starts = np.arange(offsets[-1])
+    kmer = buffer.astype(np.int64)
+
+    for k in range(1, ks[-1] + 1):
+        if k > 1:
+            extend = starts + k <= ends[protein]
+            protein, starts = protein[extend], starts[extend]
+            _, kmer = np.unique(kmer[extend] * 256 + buffer[starts + k - 1], return_inverse=True)
+            kmer = kmer.ravel()
+        if k in ks:
+            yield k, protein, kmer, starts + k < ends[protein]
+
+        # Keep only windows whose k-mer is present in more than one protein
+        pairs = np.unique(kmer * len(ends) + protein)
+        shared = np.bincount(pairs // len(ends), minlength=kmer.max(initial=-1) + 1) > 1
+        keep = shared[kmer]
+        protein, starts, kmer = protein[keep], starts[keep], kmer[keep]
+
+
+def index_overlap(n, protein, kmer, counted, rows=None, chunk=2 ** 22):
+    """Fill the :n x :n k-mer overlap matrix from a k-mer index (see kmer_layers).
+    Entry (i, j), i < j, is the number of counted windows of protein i whose k-mer occurs in protein j.
+    If :rows is given, only entries in those rows and columns are computed and the rest are 0."""
+
+    # k-mers found in a single protein can only contribute to the diagonal, so drop them
+    pairs = np.unique(kmer * n + protein)
+    present_kmer, present_protein = np.divmod(pairs, n)
+    shared = np.bincount(present_kmer) > 1
+    relabel = np.cumsum(shared) - 1
+    keep = shared[present_kmer]
+    present_kmer, present_protein = relabel[present_kmer[keep]], present_protein[keep]
+    keep = counted & shared[kmer]
+    counted_kmer, counted_protein = relabel[kmer[keep]], protein[keep]
+
+    # Accumulate count x presence products over blocks of the k-mer vocabulary
+    overlap = np.zeros((n, n))
+    width = max(1, chunk // max(n, 1))
+    order = np.argsort(counted_kmer, kind="stable")
+    counted_kmer, counted_protein = counted_kmer[order], counted_protein[order]
+    for lo in range(0, shared.sum(), width):
+        hi = lo + width
+        a = slice(*np.searchsorted(counted_kmer, [lo, hi]))
+        b = slice(*np.searchsorted(present_kmer, [lo, hi]))
+        counts = np.bincount(counted_protein[a] * width + counted_kmer[a] - lo, minlength=n * width)
+        presence = np.bincount(present_protein[b] * width + present_kmer[b] - lo, minlength=n * width)
+        counts, presence = counts.reshape(n, width), presence.reshape(n, width).astype(float)
+        if rows is None:
+            overlap += counts @ presence.T
+        else:
+            columns = counts @ presence[rows].T
+            columns[rows] = 0
+            overlap[rows] += counts[rows] @ presence.T
+            overlap[:, rows] += columns
+
+    upper = np.triu(overlap, 1)
+    return upper + upper.T
+
+
+def _window_hits(patterns, reference, mismatches):
+    """Return a patterns x windows boolean array of which windows of :reference are within :mismatches substitutions
+    of each row of :patterns (all uint8 arrays). Compiled by Numba when it is installed."""
+
+    n_patterns, length = patterns.shape
+    n_windows = len(reference) - length + 1
+    hits = np.zeros((n_patterns, n_windows), dtype=np.bool_)
+    distance = np.zeros(n_windows, dtype=np.uint16)
+    for p in range(n_patterns):
+        # Branch-free loops over windows, which the compiler vectorizes
+        distance[:] = 0
+        for i in range(length):
+            residue = patterns[p, i]
+            for w in range(n_windows):
+                distance[w] += reference[w + i] != residue
+        for w in range(n_windows):
+            hits[p, w] = distance[w] <= mismatches
+    return hits
+
+
+if numba is not None:
+    _window_hits = numba.njit(cache=True, nogil=True)(_window_hits)
+
+
+def _packed_keys(reference, patterns):
+    """Return sortable keys for the windows of uint8 array :reference and the rows of :patterns (windows of the same
+    width) that are equal exactly when they are: integers packing each residue into as few bits as the residues
+    present need, or raw bytes if those don't fit 64 bits."""
+
+    length = patterns.shape[1]
+    windows = np.lib.stride_tricks.sliding_window_view(reference, length)
+    present = np.zeros(256, dtype=bool)
+    present[reference] = True
+    present[patterns.ravel()] = True
+    codes = np.cumsum(present).astype(np.uint64)
+    bits = int(codes[-1]).bit_length()
+    if bits * length > 64:
+        void = np.dtype((np.void, length))
+        return np.ascontiguousarray(windows).view(void).ravel(), patterns.view(void).ravel()
+
+    keys = list()
+    for rows in (windows, patterns):
+        packed = np.zeros(len(rows), dtype=np.uint64)
+        for i in range(length):
+            packed = (packed << np.uint64(bits)) | codes[rows[:, i]]
+        keys.append(packed)
+    return keys
+
+
+def peptide_hits(peptides, reference, mismatches=0, positions=False, chunk=2 ** 22):
+    """Find all of :peptides (strs or a bytes array, of any lengths) in :reference (a str or uint8 encoded array)
+    with at most :mismatches substitutions at once. Returns an array of how often each peptide occurs, or with
+    :positions a list holding the array of positions of each.
+
+    Exact matches are looked up in the sorted windows of :reference. Otherwise peptides are compared to every window
+    of their length in blocks of about :chunk residue comparisons, by a compiled kernel if Numba is installed and
+    with NumPy if not."""
+
+    if type(reference) == str:
+        reference = np.frombuffer(reference.encode("ascii"), dtype=np.uint8)
+    peptides = np.asarray(peptides, dtype=bytes)
+    lengths = np.char.str_len(peptides)
+    counts = np.zeros(len(peptides), dtype=np.int64)
+    found = [np.zeros(0, dtype=np.int64)] * len(peptides)
+
+    for length in np.unique(lengths):
+        group = np.flatnonzero(lengths == length)
+        if length == 0 or length > len(reference):
+            continue
+        patterns = peptides[group].astype("S{}".format(length)).view(np.uint8).reshape(-1, length)
+        windows = np.lib.stride_tricks.sliding_window_view(reference, length)
+
+        if mismatches == 0:
+            keys, query = _packed_keys(reference, patterns)
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            lo, hi = np.searchsorted(keys, query), np.searchsorted(keys, query, side="right")
+            counts[group] = hi - lo
+            if positions:
+                for g, a, b in zip(group, lo, hi):
+                    found[g] = np.sort(order[a:b])
+            continue
+
+        step = max(1, chunk // (len(windows) * length))
+        for p in range(0, len(patterns), step):
+            block = patterns[p:p + step]
+            if numba is not None:
+                hits = _window_hits(block, reference, mismatches)
+            else:
+                # Add up mismatches one peptide position at a time, over all windows
+                distance = np.zeros((len(block), len(windows)), dtype=np.min_scalar_type(length))
+                for i in range(length):
+                    distance += block[:, i, None] != windows[:, i]
+                hits = distance <= mismatches
+            counts[group[p:p + step]] = hits.sum(axis=1)
+            if positions:
+                for g, row in zip(group[p:p + step], hits):
+                    found[g] = np.flatnonzero(row)
+
+    return found if positions else counts
+
+
+def mismatch_rows(buffer, offsets, rows, k, mismatches, targets=None, chunk=2 ** 22):
+    """Count k-mer overlap with at most :mismatches substitutions for proteins :rows against all later proteins.
+    Returns a len(:rows) x n array whose entry (r, j), j > rows[r], is the number of (window of protein rows[r],
+    window of protein j) pairs within Hamming distance :mismatches, counting the same windows as
+    compare_all_peptides.
+
+    Candidates are found by pigeonhole seeding: the k-mer is split into :mismatches + 1 blocks, at least one of
+    which must match exactly. Each pair is verified once, from the first block that matches.
+    If :targets (a boolean mask over proteins) is given, only columns of those proteins are counted."""
+
+    n = len(offsets) - 1
+    lengths = np.diff(offsets)
+    counts = np.zeros((len(rows), n))
+
+    if targets is None:
+        targets = np.ones(n, dtype=bool)
+
+    if mismatches >= k:
+        # Every pair of windows matches
+        windows = np.maximum(lengths - k + 1, 0) * targets
+        for r, i in enumerate(rows):
+            counts[r, i + 1:] = max(lengths[i] - k, 0) * windows[i + 1:]
+        return counts
+    if len(buffer) < k:
+        # No protein has a window, and no seed block fits in the buffer
+        return counts
+
+    # Seed blocks (offset, length) and, for every valid window start, the id of each seed
+    size, extra = divmod(k, mismatches + 1)
+    blocks = [(b * size + min(b, extra), size + (b < extra)) for b in range(mismatches + 1)]
+    starts = np.concatenate([np.arange(offsets[j], offsets[j + 1] - k + 1) for j in range(n) if targets[j]] +
+                            [[]]).astype(np.int64)
+    seed_ids = dict()
+    for length in set(l for _, l in blocks):
+        windows = np.lib.stride_tricks.sliding_window_view(buffer, length)
+        _, seed_ids[length] = np.unique(np.ascontiguousarray(windows).view(np.dtype((np.void, length))).ravel(),
+                                        return_inverse=True)
+    total = len(buffer)
+    index = list()
+    for o, l in blocks:
+        keys = np.sort(seed_ids[l].ravel()[starts + o].astype(np.int64) * total + starts)
+        index.append(keys)
+
+    span = np.arange(k)
+    for r, i in enumerate(rows):
+        if i + 1 >= n:
+            continue
+        metrics.count("mismatch_pairs", int(targets[i + 1:].sum()))
+        query = np.arange(offsets[i], offsets[i + 1] - k, dtype=np.int64)
+        for b, (o, l) in enumerate(blocks):
+            ids = seed_ids[l].ravel()[query + o].astype(np.int64)
+            lo = np.searchsorted(index[b], ids * total + offsets[i + 1])
+            hi = np.searchsorted(index[b], (ids + 1) * total)
+            bounds = np.concatenate([[0], np.cumsum(hi - lo)])
+
+            # Expand and verify candidates in blocks of roughly :chunk residues
+            step = max(1, chunk // k)
+            q = 0
+            while q < len(query):
+                stop = max(q + 1, np.searchsorted(bounds, bounds[q] + step, side="right") - 1)
+                sizes = (hi - lo)[q:stop]
+                target = index[b][np.repeat(lo[q:stop] - np.cumsum(sizes) + sizes, sizes) +
+                                  np.arange(sizes.sum())] % total
+                source = np.repeat(query[q:stop], sizes)
+                equal = buffer[source[:, None] + span] == buffer[target[:, None] + span]
+                hit = k - equal.sum(axis=1) <= mismatches
+                for o2, l2 in blocks[:b]:
+                    hit &= ~equal[:, o2:o2 + l2].all(axis=1)
+                counts[r] += np.bincount(np.searchsorted(offsets, target[hit], side="right") - 1, minlength=n)
+                q = stop
+
+    return counts
+
+
+def load_previous(names, matrix_fn):
+    """Arrange a previously built matrix csv :matrix_fn (header = protein names), or a layer of a matrix store given
+    as a (store_fn, key) pair, for the proteins :names.
+    Returns the arranged matrix and a boolean mask of the proteins missing from the csv, whose rows and columns
+    still need computing. Proteins found in the csv must keep their relative order, since entry (i, j) of a
+    matrix is computed from the protein that comes first."""
+
+    old_names, data = load_layer(*matrix_fn) if isinstance(matrix_fn, tuple) else csv_2_array(matrix_fn)
+    old_names[0] = old_names[0].lstrip("#").strip()
+    position = {name: i for i, name in enumerate(old_names)}
+    new = np.array([name not in position for name in names], dtype=bool)
+    kept = [position[name] for name in names if name in position]
+    if kept != sorted(kept):
+        raise Exception("Proteins in {} are in a different order than in the fasta, can't update it.".format(matrix_fn))
+
+    matrix = np.zeros((len(names), len(names)))
+    matrix[np.ix_(~new, ~new)] = data[np.ix_(kept, kept)]
+    return matrix, new
+
+
+def merge_previous(matrix, previous, new):
+    """Combine computed :matrix with :previous (see load_previous), keeping previous values for pairs of old proteins"""
+    return np.where(new[:, None] | new[None, :], matrix, previous)
+
+
+def new_pair_rows(new):
+    """Return the rows holding the pairs i < j with a protein in boolean mask :new: the rows of new proteins, and the
+    rows of other proteins with a new protein further along"""
+    later = np.flip(np.cumsum(np.flip(new))) - new
+    return np.flatnonzero(new), np.flatnonzero(~new & (later > 0))
+
+
+def update_rows(task, buffer, offsets, new, args=(), workers=1, checkpoint_dir=None, key=""):
+    """Fill the pairs i < j of an upper triangle matrix that involve a protein in boolean mask :new and leave the rest
+    0, with row task :task(buffer, offsets, rows, *args, targets) (see build_rows and mismatch_rows). Rows of new
+    proteins are computed in full, and the other rows (see new_pair_rows) only against the new columns, so adding
+    a protein to n others costs n pairs."""
+
+    new_rows, old_rows = new_pair_rows(new)
+    upper = build_rows(task, buffer, offsets, args=args + (new,), workers=workers, checkpoint_dir=checkpoint_dir,
+                       key=key + "_new_columns", rows=old_rows)
+    upper += build_rows(task, buffer, offsets, args=args, workers=workers, checkpoint_dir=checkpoint_dir,
+                        key=key + "_new_rows", rows=new_rows)
+    return upper
+
+
+def build_matrices(proteins, ks, previous=None, cache=None):
+    """Build and return a dict of triangle matrices of exact k-mer overlap for all pairs in :proteins,
+    one per k in :ks, from a single pass over the sequences.
+    :previous optionally maps k to an existing matrix csv or store layer, in which case only pairs involving proteins
+    missing from it are computed (see load_previous). With a pair_cache.PairCache :cache, only pairs of sequences
+    it doesn't hold yet are computed, and those are added to it."""
+
+    buffer, offsets = encode(proteins)
+    names = protein_names(proteins)
+    previous = {k: load_previous(names, fn) for k, fn in (previous or dict()).items()}
+    rows = None
+    if previous and len(previous) == len(set(ks)):
+        rows = np.flatnonzero(np.any([new for _, new in previous.values()], axis=0))
+    lookups = dict()
+    if cache is not None:
+        if previous:
+            raise Exception("Use either a pair cache or previous matrices, not both.")
+        digests = sequence_digests(buffer, offsets)
+        for k in set(ks):
+            mode = "kmer k={} mismatches=0".format(k)
+            lookups[k] = (mode, *cache.get_matrix(digests, mode))
+            metrics.count("cached_pairs", lookups[k][2].sum())
+        # index_overlap fills the rows and columns of :rows, so those of proteins covering every uncached pair
+        rows = np.flatnonzero(uncached_proteins(np.all([found for _, _, found in lookups.values()], axis=0)))
+
+    matrices = dict()
+    # With every pair cached, skip building the k-mer index
+    layers = kmer_layers(buffer, offsets, ks) if rows is None or len(rows) else []
+    n, rest = len(proteins), 0 if rows is None else len(proteins) - len(rows)
+    for k, protein, kmer, counted in layers:
+        with metrics.stage("kmer_overlap", k=k):
+            matrices[k] = index_overlap(n, protein, kmer, counted, rows=rows)
+        metrics.count("kmer_pairs", n * (n - 1) // 2 - rest * (rest - 1) // 2)
+        if k in previous:
+            matrices[k] = merge_previous(matrices[k], *previous[k])
+    for k, (mode, cached, found) in lookups.items():
+        upper = np.where(found, cached, np.triu(matrices[k], 1)) if k in matrices else cached
+        cache.put_matrix(digests, mode, upper, ~found)
+        matrices[k] = upper + upper.T
+    return matrices
+
+
+def build_matrix(proteins, k, mismatches=0, workers=1, checkpoint_dir=None, previous=None, cache=None):
+    """Build and return triangle matrix of k-mer overlap for all pairs in :proteins.
+    Mismatch counting is split into row blocks computed by :workers processes, and finished blocks are saved to
+    :checkpoint_dir (if given) so that an interrupted build can be resumed. If :previous names an existing matrix
+    csv (or store layer, see load_previous), only pairs involving proteins missing from it are computed. With a
+    pair_cache.PairCache :cache, only pairs missing from it are computed (see build_matrices)."""
+
+    if mismatches == 0:
+        return build_matrices(proteins, [k], previous=None if previous is None else {k: previous}, cache=cache)[k]
+
+    buffer, offsets = encode(proteins)
+    key = fingerprint(buffer, offsets, "kmer", k, mismatches)
+    if cache is not None:
+        if previous is not None:
+            raise Exception("Use either a pair cache or a previous matrix, not both.")
+        digests = sequence_digests(buffer, offsets)
+        mode = "kmer k={} mismatches={}".format(k, mismatches)
+        cached, found = cache.get_matrix(digests, mode)
+        metrics.count("cached_pairs", found.sum())
+        new = uncached_proteins(found)
+        upper = update_rows(mismatch_rows, buffer, offsets, new, args=(k, mismatches), workers=workers,
+                            checkpoint_dir=checkpoint_dir,
+                            key=fingerprint(buffer, offsets, "kmer", k, mismatches, new.tolist()))
+        upper = np.where(found, cached, upper)
+        cache.put_matrix(digests, mode, upper, ~found)
+        return upper + upper.T
+    if previous is None:
+        upper = build_rows(mismatch_rows, buffer, offsets, args=(k, mismatches), workers=workers,
+                           checkpoint_dir=checkpoint_dir, key=key)
+        return upper + upper.T
+
+    old, new = load_previous(protein_names(proteins), previous)
+    upper = update_rows(mismatch_rows, buffer, offsets, new, args=(k, mismatches), workers=workers,
+                        checkpoint_dir=checkpoint_dir, key=fingerprint(buffer, offsets, "kmer", k, mismatches,
+                                                                       new.tolist()))
+    return merge_previous(upper + upper.T, old, new)
 
 
 if __name__ == '__main__':
 
-    fasta = sys.argv[1]
-    proteins = [x for x in SeqIO.parse(fasta, "fasta")]
-    names = [x.name for x in proteins]
+    parser = argparse.ArgumentParser(description="Build k-mer overlap matrices for all pairs of proteins in a fasta")
+    parser.add_argument("fasta")
+    parser.add_argument("out_dir", nargs="?", default="naive")
+    parser.add_argument("--mismatches", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for mismatch counting")
+    parser.add_argument("--checkpoint", default=None, help="directory for resumable row blocks")
+    parser.add_argument("--update", action="store_true",
+                        help="reuse matrices already in out_dir and only compute pairs with new proteins")
+    parser.add_argument("--store", action="store_true",
+                        help="write all matrices to out_dir/matrices.imx (see store.py) instead of one csv per k")
+    pair_cache.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.cache is not None and args.update:
+        parser.error("--cache can't be combined with --update")
+
+    with metrics.session(args):
+        cache = pair_cache.from_arguments(args)
+        proteins = read_fasta(args.fasta)
+        names = proteins.names
 
-    # k-mer data from length 2 to length 17.
-    # MHC class I peptides are usually 8-12 aa long.
-    # Class II have a binding core of similar length, but may also have extended ends.
+        # k-mer data from length 2 to length 17.
+        # MHC class I peptides are usually 8-12 aa long.
+        # Class II have a binding core of similar length, but may also have extended ends.
 
-    for k in range(2, 18):
+        store_fn = "{}/matrices.imx".format(args.out_dir)
+        out_fns = {k: "{}/m{}.csv".format(args.out_dir, k) for k in range(2, 18)}
+        if not args.update:
+            previous = dict()
+        elif args.store:
+            stored = MatrixStore(store_fn).keys() if os.path.isfile(store_fn) else []
+            previous = {k: (store_fn, "m{}".format(k)) for k in range(2, 18) if "m{}".format(k) in stored}
+        else:
+            previous = {k: fn for k, fn in out_fns.items() if os.path.isfile(fn)}
 
-        out_fn = "naive/m{}.csv".format(k)
-        x = build_matrix(proteins, k, mismatches=0)
-        np.savetxt(out_fn, x, delimiter=',', fmt='%10.1f', comments="", header=",".join(names))
+        if args.mismatches == 0:
+            matrices = build_matrices(proteins, range(2, 18), previous=previous, cache=cache)
+        else:
+            matrices = {k: build_matrix(proteins, k, mismatches=args.mismatches, workers=args.jobs,
+                                        checkpoint_dir=args.checkpoint, previous=previous.get(k), cache=cache)
+                        for k in range(2, 18)}
+        if cache is not None:
+            cache.close()
+        if args.store:
+            os.makedirs(args.out_dir, exist_ok=True)
+            write_store(store_fn, names, {"m{}".format(k): matrices[k] for k in range(2, 18)})
+        else:
+            for k in range(2, 18):
+                np.savetxt(out_fns[k], matrices[k], delimiter=',', fmt='%10.1f', comments="",
+                           header=",".join(names))
@@ -0,0 +1,125 @@
+# Persistent memo of pairwise comparison values, shared by runs over overlapping protein families.
+#
+# A value is keyed by the hashes of the two sequences, in matrix order (entry (i, j), i < j, of the builders depends
+# on which protein comes first), and a mode naming the comparison and its parameters, e.g. "kmer k=5 mismatches=1".
+# The same ortholog pair in another fasta, or a parameter sweep revisiting a setting, is then only computed once.
+# Entries live in an SQLite file in WAL mode, so concurrent runs can share it: readers are never blocked and writers
+# wait up to :timeout for each other. With :max_entries, the least recently used entries are evicted.
+
+import numpy as np
+import hashlib
+import sqlite3
+import time
+
+
+def sequence_digests(buffer, offsets):
+    """Return a 16 byte hash of each encoded sequence (see naive.encode)"""
+    return [hashlib.sha1(buffer[offsets[i]:offsets[i + 1]].tobytes()).digest()[:16] for i in range(len(offsets) - 1)]
+
+
+class PairCache:
+    """Pair values stored in SQLite file :fn (see the module comment). Lookups and inserts work on whole matrices in
+    bulk (get_matrix / put_matrix), one transaction each."""
+
+    def __init__(self, fn, max_entries=None, timeout=60):
+        self.fn = fn
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(fn, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pairs (mode TEXT, a BLOB, b BLOB, value REAL, "
+                                    "used REAL, PRIMARY KEY (mode, a, b)) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS pairs_used ON pairs (used)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+
+    def get_matrix(self, digests, mode):
+        """Return the cached values of all pairs i < j of sequences :digests (see sequence_digests) for :mode, as an
+        n x n upper triangle matrix, and a boolean matrix of which pairs were found. Found entries count as used."""
+
+        n = len(digests)
+        index = dict()
+        for i, digest in enumerate(digests):
+            index.setdefault(digest, []).append(i)
+        values, found = np.zeros((n, n)), np.zeros((n, n), dtype=bool)
+
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS query (h BLOB PRIMARY KEY)")
+            self.connection.execute("DELETE FROM query")
+            self.connection.executemany("INSERT INTO query VALUES (?)", [(d,) for d in index])
+            hits = self.connection.execute("SELECT p.a, p.b, p.value FROM pairs p JOIN query qa ON p.a = qa.h "
+                                           "JOIN query qb ON p.b = qb.h WHERE p.mode = ?", (mode,)).fetchall()
+            now, used = time.time(), list()
+            for a, b, value in hits:
+                cells = [(i, j) for i in index[a] for j in index[b] if i < j]
+                if cells:
+                    rows, cols = zip(*cells)
+                    values[rows, cols] = value
+                    found[rows, cols] = True
+                    used.append((now, mode, a, b))
+        # A separate write transaction: upgrading the read above to a write fails at once, rather than waiting for
+        # the lock, if another process has written in between
+        with self.connection:
+            self.connection.executemany("UPDATE pairs SET used = ? WHERE mode = ? AND a = ? AND b = ?", used)
+        return values, found
+
+    def put_matrix(self, digests, mode, matrix, mask=None):
+        """Store entries i < j of :matrix (optionally only where boolean matrix :mask is True) as the values of the
+        pairs of sequences :digests for :mode, then evict the least recently used entries over max_entries."""
+
+        rows, cols = np.triu_indices(len(digests), 1)
+        if mask is not None:
+            keep = mask[rows, cols]
+            rows, cols = rows[keep], cols[keep]
+        now = time.time()
+        entries = [(mode, digests[i], digests[j], float(matrix[i, j]), now) for i, j in zip(rows.tolist(),
+                                                                                             cols.tolist())]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?)", entries)
+            if self.max_entries is not None:
+                excess = len(self) - self.max_entries
+                if excess > 0:
+                    self.connection.execute("DELETE FROM pairs WHERE (mode, a, b) IN (SELECT mode, a, b FROM pairs "
+                                            "ORDER BY used LIMIT ?)", (excess,))
+
+
+def uncached_proteins(found):
+    """Return a boolean mask of proteins such that every pair i < j not in upper triangle mask :found involves one of
+    them, picked greedily by most uncached pairs. A protein new to the cache is picked, and the pairs of the picked
+    proteins (see naive.update_rows) are then about all that needs computing."""
+
+    n = len(found)
+    uncached = ~found & np.triu(np.ones((n, n), dtype=bool), 1)
+    uncached |= uncached.T
+    degree = uncached.sum(axis=1)
+    picked = np.zeros(n, dtype=bool)
+    while degree.any():
+        i = np.argmax(degree)
+        picked[i] = True
+        degree -= uncached[i]
+        uncached[i] = uncached[:, i] = False
+        degree[i] = 0
+    return picked
+
+
+def add_arguments(parser):
+    """Add the --cache and --cache-size options used by from_arguments() to argparse :parser"""
+    parser.add_argument("--cache", default=None, metavar="FILE",
+                        help="SQLite file of pair values shared between runs; only uncached pairs are computed")
+    parser.add_argument("--cache-size", type=int, default=None, metavar="N",
+                        help="keep at most N pairs in --cache, evicting the least recently used")
+
+
+def from_arguments(args):
+    """Return the PairCache of parsed :args (see add_arguments), or None if there is none"""
+    return None if args.cache is None else PairCache(args.cache, max_entries=args.cache_size)
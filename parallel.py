@@ -0,0 +1,111 @@
+# Tiled, resumable computation of pair matrices over a process pool.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import metrics
+import numpy as np
+import hashlib
+import os
+
+
+# Row blocks a build is split into by default
+TILES = 64
+
+# Encoded sequences of the current build, attached once per worker process
+_shared = dict()
+
+
+def _attach(name, offsets):
+    memory = shared_memory.SharedMemory(name=name)
+    _shared["memory"] = memory
+    _shared["buffer"] = np.ndarray((offsets[-1],), dtype=np.uint8, buffer=memory.buf)
+    _shared["offsets"] = offsets
+
+
+def _run_tile(task, rows, args):
+    return task(_shared["buffer"], _shared["offsets"], rows, *args)
+
+
+def fingerprint(buffer, offsets, *params):
+    """Return a short hash identifying the encoded sequences and the parameters of a build"""
+    h = hashlib.sha1(buffer.tobytes())
+    h.update(offsets.tobytes())
+    h.update(repr(params).encode())
+    return h.hexdigest()[:16]
+
+
+def build_rows(task, buffer, offsets, args=(), workers=1, block=None, checkpoint_dir=None, key="", rows=None,
+               sparse=False):
+    """Fill an n x n matrix by row blocks, where n is the number of proteins in :buffer/:offsets (see naive.encode).
+    :task(buffer, offsets, rows, *args) must return a len(rows) x n array and be importable by worker processes.
+
+    With :workers > 1, blocks are computed by a ProcessPoolExecutor that reads the sequences from shared memory.
+    If :checkpoint_dir is given, every finished block is saved there under :key and reused by later runs, so an
+    interrupted build resumes where it stopped. If :rows is given, only those rows are computed and the rest are 0.
+    With :sparse, :task returns an array of entries for its rows instead (e.g. the nonzero cells in coordinate form)
+    and the entries of all blocks are returned concatenated in row order (None if there are no rows)."""
+
+    n = len(offsets) - 1
+    rows = np.arange(n) if rows is None else np.asarray(rows, dtype=np.int64)
+    if block is None:
+        # Rows near the top of the triangle are the most expensive, so split into several blocks per worker. The
+        # split doesn't depend on :workers, so a checkpointed build can resume with any number of them.
+        block = max(1, -(-len(rows) // TILES))
+    tiles = [rows[start:start + block] for start in range(0, len(rows), block)]
+    matrix = None if sparse else np.zeros((n, n))
+    entries = dict()
+
+    def keep(tile, values):
+        if sparse:
+            entries[tile[0]] = values
+        else:
+            matrix[tile] = values
+
+    def tile_fn(tile):
+        return os.path.join(checkpoint_dir, "{}_{}_{}.npy".format(key, tile[0], tile[-1] + 1))
+
+    todo = list()
+    for tile in tiles:
+        if checkpoint_dir is not None and os.path.isfile(tile_fn(tile)):
+            keep(tile, np.load(tile_fn(tile)))
+        else:
+            todo.append(tile)
+
+    progress = metrics.Progress("rows", sum(len(tile) for tile in todo), unit="rows")
+
+    def finish(tile, values):
+        keep(tile, values)
+        if checkpoint_dir is not None:
+            tmp = tile_fn(tile) + ".tmp.npy"
+            np.save(tmp, values)
+            os.replace(tmp, tile_fn(tile))
+        progress.update(len(tile))
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    if workers <= 1 or len(todo) <= 1:
+        for tile in todo:
+            finish(tile, task(buffer, offsets, tile, *args))
+        progress.close()
+        return _result(matrix, entries)
+
+    memory = shared_memory.SharedMemory(create=True, size=max(1, buffer.nbytes))
+    try:
+        np.ndarray(buffer.shape, dtype=np.uint8, buffer=memory.buf)[:] = buffer
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach,
+                                 initargs=(memory.name, offsets)) as pool:
+            futures = {pool.submit(_run_tile, task, tile, args): t for t, tile in enumerate(todo)}
+            for future in as_completed(futures):
+                finish(todo[futures[future]], future.result())
+    finally:
+        memory.close()
+        memory.unlink()
+    progress.close()
+    return _result(matrix, entries)
+
+
+def _result(matrix, entries):
+    if matrix is not None:
+        return matrix
+    return np.concatenate([entries[start] for start in sorted(entries)]) if entries else None
@@ -0,0 +1,251 @@
+# The whole analysis as one command: fasta -> (prune) -> predictions / k-mer matrices -> MHC matrix -> orthogonality
+# graph -> cliques or partitions.
+#
+# Every stage declares the stages it reads and the parameters it uses. Its output is a directory,
+# cache_dir/<stage>/<key>, where key hashes the stage name and version, its parameters and the keys of the stages it
+# reads, with input files hashed by content. A rerun reuses each stage whose key already has an output and only
+# recomputes stale ones. Outputs are built in a temporary directory that is renamed into place when the stage
+# finishes, so an interrupted run leaves nothing half written in the cache.
+
+from bron_kerbosch import find_cliques, matrix_graph, maximum_cliques, partitions
+from collections import namedtuple
+from fasta import read_fasta
+from functools import partial
+from main import DEFAULT_ALLELES, NETMHC_I, NETMHC_II, build_MHCI_matrix, build_MHCII_matrix, run_predictions
+from naive import build_matrices, build_matrix, prune_similar
+from store import load_layer, write_store
+import argparse
+import hashlib
+import json
+import metrics
+import os
+import shutil
+import time
+
+
+# run(out_dir, input_dirs, **params) writes the stage output to out_dir, and returns False if that output must not be
+# cached (e.g. a search cut short by its time limit), in which case it is kept next to the cache entry as
+# <key>.incomplete and the stage runs again next time. Only name, version, params and the inputs go in the key, so
+# options that do not change the output (e.g. worker counts) are bound into run instead. Params named in files are
+# paths whose contents are hashed (see file_digest). Bump version when a stage's output changes.
+Stage = namedtuple("Stage", ["name", "run", "inputs", "params", "files", "version"], defaults=((), 1))
+
+PREDICTORS = {1: NETMHC_I, 2: NETMHC_II}
+
+
+def file_digest(path):
+    """Return the sha1 of file :path's contents. Directories (e.g. of predictions) are hashed by the name, size and
+    modification time of their files rather than read in full."""
+
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.is_file():
+                stat = entry.stat()
+                h.update("{}\t{}\t{}\n".format(entry.name, stat.st_size, stat.st_mtime_ns).encode())
+    else:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def stage_key(stage, input_keys):
+    """Return the cache key of :stage given the keys of the stages it reads"""
+    params = dict(stage.params)
+    for name in stage.files:
+        if params[name] is not None:
+            params[name] = file_digest(params[name])
+    text = json.dumps([stage.name, stage.version, params, input_keys], sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def run_pipeline(stages, cache_dir, force=(), dry_run=False):
+    """Run :stages (in order, each after the stages it reads) with outputs cached under :cache_dir and return the
+    output directory of each stage by name. Stages named in :force are rebuilt even if cached. With :dry_run, only
+    report which stages are cached and which would run."""
+
+    keys, outputs = dict(), dict()
+    for stage in stages:
+        unknown = [name for name in stage.inputs if name not in keys]
+        if unknown:
+            raise Exception("Stage {} reads {}, which come after it or do not exist.".format(stage.name, unknown))
+        keys[stage.name] = stage_key(stage, [keys[name] for name in stage.inputs])
+        out_dir = os.path.join(cache_dir, stage.name, keys[stage.name])
+        outputs[stage.name] = out_dir
+
+        if os.path.isdir(out_dir) and stage.name not in force:
+            print("{:12s} cached  {}".format(stage.name, out_dir))
+            continue
+        print("{:12s} {}  {}".format(stage.name, "stale " if dry_run else "run   ", out_dir), flush=True)
+        if dry_run:
+            continue
+        tmp = out_dir + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        with metrics.stage("pipeline/" + stage.name):
+            complete = stage.run(tmp, [outputs[name] for name in stage.inputs], **stage.params) is not False
+        if complete:
+            shutil.rmtree(out_dir + ".incomplete", ignore_errors=True)
+        else:
+            print("{:12s} incomplete, not cached".format(stage.name))
+            outputs[stage.name] = out_dir + ".incomplete"
+        shutil.rmtree(outputs[stage.name], ignore_errors=True)
+        os.replace(tmp, outputs[stage.name])
+    return outputs
+
+
+# Stage functions. Proteins are passed on as out_dir/proteins.fasta, matrices as out_dir/matrices.imx (see store.py).
+
+def write_fasta(fn, proteins):
+    with open(fn, mode="w") as out:
+        for protein in proteins:
+            print(">{}\n{}".format(protein.name, protein.seq), file=out)
+
+
+def fasta_stage(out_dir, inputs, fasta):
+    shutil.copyfile(fasta, os.path.join(out_dir, "proteins.fasta"))
+
+
+def prune_stage(out_dir, inputs, threshold):
+    proteins = read_fasta(os.path.join(inputs[0], "proteins.fasta"))
+    kept = prune_similar(proteins, threshold=threshold)
+    print("Kept {} of {} proteins".format(len(kept), len(proteins)))
+    write_fasta(os.path.join(out_dir, "proteins.fasta"), kept)
+
+
+def kmer_stage(out_dir, inputs, ks, mismatches, workers=1):
+    proteins = read_fasta(os.path.join(inputs[0], "proteins.fasta"))
+    if mismatches == 0:
+        matrices = build_matrices(proteins, ks)
+    else:
+        matrices = {k: build_matrix(proteins, k, mismatches=mismatches, workers=workers) for k in ks}
+    write_store(os.path.join(out_dir, "matrices.imx"), proteins.names,
+                {"m{}".format(k): matrices[k] for k in ks})
+
+
+def predictions_stage(out_dir, inputs, MHC, source, alleles, predictor, workers=1, timeout=None, retries=2):
+    """Collect the prediction of each protein from :source (if given) and run :predictor for the rest"""
+    proteins = read_fasta(os.path.join(inputs[0], "proteins.fasta"))
+    missing = list()
+    for protein in proteins:
+        fn = "{}.tsv".format(protein.name)
+        if source is not None and os.path.isfile(os.path.join(source, fn)):
+            shutil.copyfile(os.path.join(source, fn), os.path.join(out_dir, fn))
+        else:
+            missing.append(protein)
+    if missing:
+        print("Running predictor on {} proteins".format(len(missing)))
+        run_predictions(missing, out_dir, MHC, alleles or DEFAULT_ALLELES[MHC], predictor, workers=workers,
+                        timeout=timeout, retries=retries)
+
+
+def mhc_stage(out_dir, inputs, MHC, threshold, workers=1):
+    fasta = os.path.join(inputs[0], "proteins.fasta")
+    build = build_MHCI_matrix if MHC == 1 else build_MHCII_matrix
+    # Each prediction is parsed once per build, and the predictions stage's output is not written to once cached
+    matrix = build(fasta, inputs[1], threshold=threshold, run_missing_predictions=False, workers=workers,
+                   prediction_cache=False)
+    layer = "MHCI" if MHC == 1 else "MHCII"
+    write_store(os.path.join(out_dir, "matrices.imx"), read_fasta(fasta).names, {layer: matrix})
+
+
+def graph_stage(out_dir, inputs, layer, threshold):
+    names, data = load_layer(os.path.join(inputs[0], "matrices.imx"), layer)
+    with open(os.path.join(out_dir, "graph.json"), mode="w") as out:
+        json.dump(matrix_graph(names, data, threshold=threshold), out, indent=1)
+
+
+def cliques_stage(out_dir, inputs, method, top, time_limit=None):
+    with open(os.path.join(inputs[0], "graph.json")) as f:
+        graph = json.load(f)
+    start = time.time()
+    if method == "find_cliques":
+        result = [sorted(c) for c in find_cliques(graph)]
+    elif method == "maximum_cliques":
+        result = [sorted(c) for c in maximum_cliques(graph, time_limit=time_limit)]
+    else:
+        result = [[sorted(c) for c in p] for p in partitions(graph, top=top, time_limit=time_limit)]
+    with open(os.path.join(out_dir, "cliques.json"), mode="w") as out:
+        json.dump(result, out, indent=1)
+    # Results cut short by the time limit may improve with more time, so only complete ones are cached
+    return time_limit is None or time.time() < start + time_limit
+
+
+def pipeline_stages(args):
+    """Return the stages needed for the command line :args of this script, in the order they run"""
+
+    stages = [Stage("fasta", fasta_stage, [], {"fasta": args.fasta}, files=("fasta",))]
+    proteins = "fasta"
+    if args.prune is not None:
+        stages.append(Stage("prune", prune_stage, [proteins], {"threshold": args.prune}))
+        proteins = "prune"
+
+    if args.layer in ("MHCI", "MHCII"):
+        MHC = 1 if args.layer == "MHCI" else 2
+        stages.append(Stage("predictions", partial(predictions_stage, workers=args.jobs, timeout=args.predictor_timeout,
+                                                   retries=args.predictor_retries), [proteins],
+                            {"MHC": MHC, "source": args.predictions, "alleles": args.alleles,
+                             "predictor": PREDICTORS[MHC]}, files=("source",)))
+        stages.append(Stage("mhc", partial(mhc_stage, workers=args.jobs), [proteins, "predictions"],
+                            {"MHC": MHC, "threshold": args.rank}))
+        matrices = "mhc"
+    else:
+        stages.append(Stage("kmer", partial(kmer_stage, workers=args.jobs), [proteins],
+                            {"ks": args.k, "mismatches": args.mismatches}))
+        matrices = "kmer"
+
+    stages.append(Stage("graph", graph_stage, [matrices], {"layer": args.layer, "threshold": args.threshold}))
+    # Only complete searches are cached, and those don't depend on the time limit
+    stages.append(Stage("cliques", partial(cliques_stage, time_limit=args.time_limit or None), ["graph"],
+                        {"method": args.method, "top": args.top}))
+    return stages
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run fasta -> (prune) -> matrices -> graph -> cliques/partitions, "
+                                                 "reusing every cached stage whose inputs and parameters are unchanged")
+    parser.add_argument("fasta")
+    parser.add_argument("--cache-dir", default=".pipeline", help="directory holding the output of every stage")
+    parser.add_argument("--prune", type=int, default=None, metavar="DIFFERENCES",
+                        help="first drop proteins within this many positions of an earlier one (see prune_similar)")
+    parser.add_argument("--layer", default="m5",
+                        help="matrix the graph is built from: m<k> for k-mer overlap, or MHCI / MHCII")
+    parser.add_argument("--k", type=int, nargs="+", default=list(range(2, 18)), help="k-mer lengths to build")
+    parser.add_argument("--mismatches", type=int, default=0)
+    parser.add_argument("--predictions", default=None,
+                        help="directory of existing <protein>.tsv predictions; the predictor runs for the rest")
+    parser.add_argument("--alleles", nargs="+", default=None, help="alleles to predict (default as in main.py)")
+    parser.add_argument("--predictor-timeout", type=float, default=None, metavar="SECONDS",
+                        help="kill and retry predictor runs taking longer than this")
+    parser.add_argument("--predictor-retries", type=int, default=2, metavar="N",
+                        help="times a failed or timed out predictor run is retried")
+    parser.add_argument("--rank", type=float, default=2, help="percentile rank below which a peptide binds")
+    parser.add_argument("--threshold", type=float, default=0.0,
+                        help="proteins are joined in the graph when their overlap is at most this")
+    parser.add_argument("--method", default="partitions", choices=["find_cliques", "maximum_cliques", "partitions"])
+    parser.add_argument("--top", type=int, default=10, help="partitions to keep")
+    parser.add_argument("--time-limit", type=float, default=60,
+                        help="seconds for maximum_cliques/partitions, 0 for no limit; the best found by then is "
+                             "reported but not cached")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for predictions and comparisons")
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE", help="rebuild these stages even if cached")
+    parser.add_argument("--dry-run", action="store_true", help="only show which stages are cached and which are stale")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.layer not in ("MHCI", "MHCII") and (not args.layer.startswith("m") or
+                                                 not args.layer[1:].isdigit() or int(args.layer[1:]) not in args.k):
+        parser.error("--layer must be MHCI, MHCII or m<k> for one of the --k lengths")
+
+    with metrics.session(args):
+        outputs = run_pipeline(pipeline_stages(args), args.cache_dir, force=args.force, dry_run=args.dry_run)
+        if not args.dry_run:
+            with open(os.path.join(outputs["cliques"], "cliques.json")) as f:
+                result = json.load(f)
+            if args.method == "partitions":
+                for p in result:
+                    print("{} rounds: {}".format(len(p), " | ".join(",".join(c) for c in p)))
+            else:
+                for c in result:
+                    print("{} proteins: {}".format(len(c), ",".join(c)))
@@ -0,0 +1,265 @@
+# Long-lived query service over precomputed overlap matrices, for interactive design sessions.
+#
+# The server opens each protein family once (matrix stores stay memory-mapped, see store.py) and keeps the
+# orthogonality graph of every (family, layer, threshold) it is asked about as integer bitsets, together with the
+# maximum cliques of the residual graphs its partition searches have visited. Answers are kept in an LRU, so repeated
+# questions cost a dict lookup. Requests and answers are JSON lines over a local TCP socket, and the same script is
+# the command line client:
+#
+#   python query_server.py serve Cas9=cas9.imx AAV=k-mer_comparisons/AAV &
+#   python query_server.py largest Cas9 AAK33936.1 --layer m5 --threshold 1
+
+from bron_kerbosch import bitset_maximum_cliques, bitset_nodes, bitset_partitions, matrix_bitsets
+from collections import OrderedDict
+from store import MatrixStore, read_csv
+import numpy as np
+import argparse
+import json
+import metrics
+import os
+import socket
+import socketserver
+import threading
+import time
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8642
+
+
+def open_family(path):
+    """Return the protein names of a family and a dict of its layers, each a function returning the layer's matrix.
+    :path is a matrix store, a matrix csv (one layer named after the file) or a directory of matrix csvs, such as
+    k-mer_comparisons/Cas9. Csvs are read on first use, store layers are memory-mapped."""
+
+    if os.path.isdir(path):
+        fns = sorted(os.path.join(path, fn) for fn in os.listdir(path) if fn.endswith(".csv"))
+    elif path.endswith(".csv"):
+        fns = [path]
+    else:
+        store = MatrixStore(path)
+        return list(store.names), {key: (lambda key=key: store[key]) for key in store.keys()}
+    if not fns:
+        raise Exception("No matrix csvs in {}.".format(path))
+
+    def load(fn):
+        names, data = read_csv(fn)
+        names[0] = names[0].lstrip("#").strip()
+        return data
+
+    names, _ = read_csv(fns[0])
+    names[0] = names[0].lstrip("#").strip()
+    return names, {os.path.splitext(os.path.basename(fn))[0]: (lambda fn=fn: load(fn)) for fn in fns}
+
+
+class OrthogonalityGraph:
+    """Orthogonality graph of overlap matrix :data at :threshold (see bron_kerbosch.matrix_bitsets), with nodes
+    renumbered by decreasing degree as maximum_cliques does, and a memo of residual graph cliques shared by all
+    partition searches."""
+
+    def __init__(self, names, data, threshold):
+        mask = np.asarray(data) <= threshold
+        np.fill_diagonal(mask, False)
+        order = np.argsort(-mask.sum(axis=1), kind="stable")
+        self.nodes = [names[i] for i in order]
+        self.index = {v: i for i, v in enumerate(self.nodes)}
+        self.adjacency = matrix_bitsets(np.asarray(data)[np.ix_(order, order)], threshold)
+        self.memo = dict()
+
+    def position(self, protein):
+        if protein not in self.index:
+            raise Exception("Unknown protein {}.".format(protein))
+        return self.index[protein]
+
+    def largest(self, protein, deadline=None):
+        """Return the largest orthogonal sets containing :protein, as lists of names"""
+        i = self.position(protein)
+        cliques = bitset_maximum_cliques(self.adjacency, 1 << i, self.adjacency[i], deadline=deadline)
+        return [sorted(bitset_nodes(c, self.nodes)) for c in cliques]
+
+    def conflicts(self, proteins):
+        """Return the pairs of :proteins that are not orthogonal"""
+        positions = [self.position(protein) for protein in proteins]
+        return [[proteins[a], proteins[b]] for a in range(len(positions)) for b in range(a + 1, len(positions))
+                if not self.adjacency[positions[a]] >> positions[b] & 1 or
+                not self.adjacency[positions[b]] >> positions[a] & 1]
+
+    def partitions(self, top=10, deadline=None):
+        """Return the best :top partitions into rounds of orthogonal proteins (see bron_kerbosch.partitions)"""
+        best = bitset_partitions(self.adjacency, self.memo, top=top, deadline=deadline)
+        return [[sorted(bitset_nodes(c, self.nodes)) for c in chosen] for chosen in best]
+
+
+class QueryService:
+    """Answers queries about :families (dict of name -> open_family() result). Keeps up to :graphs orthogonality
+    graphs and :results answers, least recently used first out. Queries are answered one at a time."""
+
+    def __init__(self, families, graphs=64, results=1024):
+        self.families = families
+        self.max_graphs = graphs
+        self.max_results = results
+        self.graphs = OrderedDict()
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def graph(self, family, layer, threshold):
+        """Return the OrthogonalityGraph of :layer of :family at :threshold, building it on first use"""
+        key = (family, layer, float(threshold))
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+            return self.graphs[key]
+        if family not in self.families:
+            raise Exception("Unknown family {}.".format(family))
+        names, layers = self.families[family]
+        if layer not in layers:
+            raise Exception("Family {} has no layer {}.".format(family, layer))
+        with metrics.stage("query/graph", family=family, layer=layer):
+            self.graphs[key] = OrthogonalityGraph(names, layers[layer](), threshold)
+        if len(self.graphs) > self.max_graphs:
+            self.graphs.popitem(last=False)
+        return self.graphs[key]
+
+    def answer(self, request):
+        """Return the answer to :request, a dict with "query" and its arguments (see the client commands below)"""
+
+        key = json.dumps(request, sort_keys=True)
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                metrics.count("query_result_hits")
+                return self.results[key]
+
+            query = request["query"]
+            time_limit = request.get("time_limit")
+            deadline = None if time_limit is None else time.time() + time_limit
+            with metrics.stage("query/" + query):
+                if query == "families":
+                    result = {family: {"proteins": len(names), "layers": sorted(layers)}
+                              for family, (names, layers) in self.families.items()}
+                else:
+                    graph = self.graph(request["family"], request.get("layer", "m5"), request.get("threshold", 0.0))
+                    if query == "largest":
+                        cliques = graph.largest(request["protein"], deadline=deadline)
+                        result = {"size": len(cliques[0]) if cliques else 0, "sets": cliques}
+                    elif query == "orthogonal":
+                        conflicts = graph.conflicts(request["proteins"])
+                        result = {"orthogonal": not conflicts, "conflicts": conflicts}
+                    elif query == "partitions":
+                        result = {"partitions": graph.partitions(top=request.get("top", 10), deadline=deadline)}
+                    else:
+                        raise Exception("Unknown query {}.".format(query))
+
+            # Answers cut short by the time limit may improve with more time, so only complete ones are kept
+            if deadline is None or time.time() < deadline:
+                self.results[key] = result
+                if len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+            return result
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            start = time.perf_counter()
+            try:
+                reply = {"ok": True, "result": self.server.service.answer(json.loads(line))}
+            except Exception as error:
+                reply = {"ok": False, "error": str(error)}
+            reply["seconds"] = round(time.perf_counter() - start, 6)
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Answer requests for :service on :host/:port until interrupted"""
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((host, port), _Handler) as server:
+        server.daemon_threads = True
+        server.service = service
+        print("Serving {} families on {}:{}".format(len(service.families), host, port), flush=True)
+        server.serve_forever()
+
+
+def query(request, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Send :request to the server on :host/:port and return its answer and the seconds the server took"""
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        with connection.makefile("rb") as f:
+            reply = json.loads(f.readline())
+    if not reply["ok"]:
+        raise Exception(reply["error"])
+    return reply["result"], reply["seconds"]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve orthogonal set queries over precomputed overlap matrices, "
+                                                 "or ask a running server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    server_parser = commands.add_parser("serve", help="load the families and answer queries until interrupted")
+    server_parser.add_argument("families", nargs="+", metavar="[NAME=]PATH",
+                               help="matrix store, matrix csv or directory of csvs; NAME defaults to the file name")
+    server_parser.add_argument("--warm", type=float, nargs="*", default=[0.0], metavar="THRESHOLD",
+                               help="build the graphs of every layer at these thresholds before serving")
+    server_parser.add_argument("--graphs", type=int, default=64, help="orthogonality graphs to keep")
+    server_parser.add_argument("--results", type=int, default=1024, help="answers to keep")
+    metrics.add_arguments(server_parser)
+
+    commands.add_parser("families", help="list the families and layers being served")
+    for name, text in (("largest", "largest orthogonal sets containing a protein"),
+                       ("orthogonal", "check whether proteins are mutually orthogonal"),
+                       ("partitions", "best partitions of a family into rounds of orthogonal proteins")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("family")
+        if name == "largest":
+            command.add_argument("protein")
+        elif name == "orthogonal":
+            command.add_argument("proteins", nargs="+")
+        else:
+            command.add_argument("--top", type=int, default=10)
+        command.add_argument("--layer", default="m5", help="matrix layer, e.g. m5 or MHCI")
+        command.add_argument("--threshold", type=float, default=0.0,
+                             help="proteins are orthogonal when their overlap is at most this")
+        if name != "orthogonal":
+            command.add_argument("--time-limit", type=float, default=None, help="seconds to search for")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        with metrics.session(args):
+            families = dict()
+            for entry in args.families:
+                name, _, path = entry.rpartition("=")
+                families[name or os.path.splitext(os.path.basename(path.rstrip("/")))[0]] = open_family(path)
+            service = QueryService(families, graphs=args.graphs, results=args.results)
+            for family, (_, layers) in families.items():
+                for layer in layers:
+                    for threshold in args.warm:
+                        service.graph(family, layer, threshold)
+            try:
+                serve(service, host=args.host, port=args.port)
+            except KeyboardInterrupt:
+                pass
+    else:
+        request = {key: value for key, value in vars(args).items() if key not in ("host", "port", "command")}
+        request["query"] = args.command
+        try:
+            result, seconds = query(request, host=args.host, port=args.port)
+        except Exception as error:
+            parser.exit(1, "{}\n".format(error))
+        if args.command == "families":
+            for family, info in result.items():
+                print("{}: {} proteins, layers {}".format(family, info["proteins"], ",".join(info["layers"])))
+        elif args.command == "largest":
+            print("{} sets of {} proteins".format(len(result["sets"]), result["size"]))
+            for members in result["sets"]:
+                print(",".join(members))
+        elif args.command == "orthogonal":
+            print("orthogonal" if result["orthogonal"] else
+                  "not orthogonal: " + " ".join("{}-{}".format(a, b) for a, b in result["conflicts"]))
+        else:
+            for p in result["partitions"]:
+                print("{} rounds: {}".format(len(p), " | ".join(",".join(c) for c in p)))
+        print("{:.2f} ms".format(seconds * 1000))
@@ -0,0 +1,171 @@
+# Compact binary store for the overlap matrices of a protein family.
+#
+# One file holds the protein names and any number of named matrix layers (e.g. m2 ... m17 from naive.py).
+# Layout: MAGIC, an 8 byte little endian header length, a JSON header, then the raw layer data, each layer aligned to
+# ALIGN bytes so it can be memory-mapped. Symmetric matrices and matrices with an empty lower triangle (MHC
+# comparisons only fill i < j) keep just their upper triangle, row by row, in the smallest dtype holding the values.
+
+from bron_kerbosch import csv_2_array
+import numpy as np
+import argparse
+import json
+import os
+
+
+MAGIC = b"IMXSTORE1\n"
+ALIGN = 64
+
+
+def smallest_dtype(matrix):
+    """Return the smallest integer dtype holding every value of :matrix, or its own dtype if it is not integral"""
+    if matrix.size == 0:
+        return np.dtype(np.uint8)
+    if not np.array_equal(matrix, np.round(matrix)):
+        return matrix.dtype
+    low, high = int(matrix.min()), int(matrix.max())
+    return np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+
+
+def matrix_layout(matrix):
+    """Return how a square :matrix is stored: "symmetric", "upper" (lower triangle all zero) or "full" """
+    if np.array_equal(matrix, matrix.T):
+        return "symmetric"
+    if not np.tril(matrix, -1).any():
+        return "upper"
+    return "full"
+
+
+def write_store(fn, names, layers):
+    """Write the square matrices :layers (dict of name -> matrix, rows and columns ordered as :names) to store :fn"""
+
+    n = len(names)
+    iu = np.triu_indices(n)
+    blobs, meta = list(), dict()
+    offset = 0
+    for key, matrix in layers.items():
+        matrix = np.asarray(matrix)
+        if matrix.shape != (n, n):
+            raise Exception("Layer {} is {}, expected {} x {} for the names given.".format(key, matrix.shape, n, n))
+        layout = matrix_layout(matrix)
+        values = matrix.ravel() if layout == "full" else matrix[iu]
+        values = values.astype(smallest_dtype(values))
+        offset += -offset % ALIGN
+        meta[str(key)] = {"layout": layout, "dtype": values.dtype.str, "offset": offset, "count": int(values.size)}
+        blobs.append((offset, values))
+        offset += values.nbytes
+
+    header = json.dumps({"names": list(names), "layers": meta}).encode()
+    start = len(MAGIC) + 8 + len(header)
+    start += -start % ALIGN
+    header += b" " * (start - len(MAGIC) - 8 - len(header))
+
+    tmp = fn + ".tmp"
+    with open(tmp, "wb") as out:
+        out.write(MAGIC)
+        out.write(len(header).to_bytes(8, "little"))
+        out.write(header)
+        for position, values in blobs:
+            out.seek(start + position)
+            out.write(values.tobytes())
+    os.replace(tmp, fn)
+
+
+class MatrixStore:
+    """Read access to a store written by write_store. Layers are memory-mapped, so opening a store only reads its
+    header, and a layer is only read from disk when it is used."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("{} is not a matrix store.".format(fn))
+            length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(length))
+        self.start = len(MAGIC) + 8 + length
+        self.names = header["names"]
+        self.layers = header["layers"]
+
+    def keys(self):
+        return list(self.layers)
+
+    def __contains__(self, key):
+        return str(key) in self.layers
+
+    def values(self, key):
+        """Return the stored values of layer :key as a read-only memmap: the upper triangle (row by row) or, for
+        "full" layers, the whole matrix"""
+        layer = self.layers[str(key)]
+        if layer["count"] == 0:
+            return np.zeros(0, dtype=layer["dtype"])
+        return np.memmap(self.fn, dtype=layer["dtype"], mode="r", offset=self.start + layer["offset"],
+                         shape=(layer["count"],))
+
+    def __getitem__(self, key):
+        """Return layer :key as a square matrix in its stored dtype"""
+        layer = self.layers[str(key)]
+        n = len(self.names)
+        values = self.values(key)
+        if layer["layout"] == "full":
+            return values.reshape(n, n)
+        matrix = np.zeros((n, n), dtype=values.dtype)
+        iu = np.triu_indices(n)
+        matrix[iu] = values
+        if layer["layout"] == "symmetric":
+            matrix.T[iu] = values
+        return matrix
+
+
+def load_layer(fn, key):
+    """Return the protein names and layer :key (as floats, like csv_2_array) of store :fn"""
+    store = MatrixStore(fn)
+    return list(store.names), store[key].astype(float)
+
+
+def read_csv(fn):
+    """Parse a matrix csv with csv_2_array, detecting rows that end in a comma"""
+    with open(fn) as f:
+        f.readline()
+        trailing = f.readline().rstrip().endswith(",")
+    return csv_2_array(fn, trailing=trailing)
+
+
+def import_csv(fn, csv_fns):
+    """Write the matrix csvs :csv_fns to store :fn, one layer per csv named after the file (e.g. m6 for m6.csv)"""
+    names, layers = None, dict()
+    for csv_fn in csv_fns:
+        csv_names, data = read_csv(csv_fn)
+        csv_names[0] = csv_names[0].lstrip("#").strip()
+        if names is None:
+            names = csv_names
+        elif csv_names != names:
+            raise Exception("{} has different proteins than {}.".format(csv_fn, csv_fns[0]))
+        layers[os.path.splitext(os.path.basename(csv_fn))[0]] = data
+    write_store(fn, names or [], layers)
+
+
+def export_csv(fn, out_dir, keys=None):
+    """Write the layers :keys (default all) of store :fn to out_dir/<key>.csv in the layout np.savetxt gives them"""
+    store = MatrixStore(fn)
+    os.makedirs(out_dir, exist_ok=True)
+    for key in keys or store.keys():
+        np.savetxt(os.path.join(out_dir, "{}.csv".format(key)), store[key], delimiter=',', fmt='%10.1f', comments="",
+                   header=",".join(store.names))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert overlap matrices between csv files and a matrix store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    to_store = commands.add_parser("import", help="write csv matrices into a store")
+    to_store.add_argument("store")
+    to_store.add_argument("csv", nargs="+")
+    to_csv = commands.add_parser("export", help="write the layers of a store as csv matrices")
+    to_csv.add_argument("store")
+    to_csv.add_argument("out_dir")
+    to_csv.add_argument("keys", nargs="*")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        import_csv(args.store, args.csv)
+    else:
+        export_csv(args.store, args.out_dir, args.keys)
@@ -0,0 +1,32 @@
+# Stand-in for netMHC-4.0: prints deterministic class I predictions in its output format for every protein and allele.
+
+import sys
+import zlib
+
+
+def main(args):
+    alleles = args[args.index("-a") + 1].split(",")
+    seqs = dict()
+    with open(args[args.index("-f") + 1]) as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:]
+                seqs[name] = ""
+            elif line:
+                seqs[name] += line
+    print("# NetMHC version 4.0 (stub)")
+    for allele in alleles:
+        for name, seq in seqs.items():
+            print("-" * 10)
+            for length in (8, 9, 10, 11):
+                for i in range(len(seq) - length + 1):
+                    peptide = seq[i:i + length]
+                    rank = zlib.crc32((allele + peptide).encode()) % 10000 / 100
+                    print("    {}  {}  {}  {}  0  0  0  0  0  {}  {}  0.5  100.0  {}{}".format(
+                        i, allele, peptide, peptide[:9], peptide, name, rank, " <= WB" if rank < 2 else ""))
+            print("Protein {}. Allele {}. Number of high binders 0".format(name, allele))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,23 @@
+# Immune overlap matrices built while a stub predictor runs, against those built from finished predictions (main.py).
+
+from main import build_MHCI_matrix
+import numpy as np
+import os
+import sys
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+FASTA = os.path.join(DATA, "proteins.fasta")
+PREDICTOR = "{} {} -a {{alleles}} -f {{fasta}}".format(sys.executable, os.path.join(DATA, "netmhc_stub.py"))
+ALLELES = ["HLA-A0101", "HLA-A0201", "HLA-B0702"]
+
+
+def test_streamed_build_matches_serial_build(tmp_path):
+    prediction_dir = str(tmp_path)
+    # Missing predictions: proteins are compared as the predictor tasks finish
+    streamed = build_MHCI_matrix(FASTA, prediction_dir, alleles=ALLELES, predictor=PREDICTOR, workers=3,
+                                 prediction_cache=False)
+    assert len(os.listdir(prediction_dir)) == len(streamed)
+    serial = build_MHCI_matrix(FASTA, prediction_dir, run_missing_predictions=False, prediction_cache=False)
+    assert serial.sum() > 0
+    assert np.array_equal(streamed, serial)
+
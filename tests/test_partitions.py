@@ -0,0 +1,36 @@
+# Partitions of orthogonality graphs into rounds of mutually orthogonal proteins (bron_kerbosch.py).
+
+from bron_kerbosch import iter_partitions, partitions
+import itertools
+import random
+
+
+def distinct(found):
+    return {frozenset(frozenset(c) for c in p) for p in found}
+
+
+def test_equal_cliques_in_any_order_are_one_partition():
+    graph = {1: [2], 2: [1], 3: [4], 4: [3], 5: [6], 6: [5]}
+    assert partitions(graph) == [[{1, 2}, {3, 4}, {5, 6}]]
+    assert len(list(iter_partitions(graph))) == 1
+
+
+def test_partitions_are_distinct_and_best_first():
+    random.seed(0)
+    for _ in range(50):
+        graph = {v: [] for v in range(9)}
+        for a, b in itertools.combinations(graph, 2):
+            if random.random() < 0.5:
+                graph[a].append(b)
+                graph[b].append(a)
+        every = list(iter_partitions(graph))
+        assert len(distinct(every)) == len(every)
+
+        score = lambda p: (-len(p), sorted((len(c) for c in p), reverse=True))
+        best = partitions(graph, top=3)
+        assert len(distinct(best)) == len(best)
+        assert [score(p) for p in best] == sorted(map(score, every), reverse=True)[:3]
+
+
+def test_empty_graph():
+    assert partitions(dict()) == [[]]